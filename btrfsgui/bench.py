@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""Measure how long the root helper takes to become ready, when run
+locally, through sudo, over ssh, or attached to as a daemon:
+
+python3 -m btrfsgui.bench [-n <runs>] [-s <sudo>] [-R <host> ...]
+                          [-D <socket>]
+
+Each launch is timed from starting the process to reading the helper's
+ready message, using the same command lines as the GUI.
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+from btrfsgui.sudo import start_helper, DaemonSession
+from btrfsgui.requester import RequesterException
+
+def time_to_ready(params, host):
+	"""Start a helper (or attach to the daemon, if host is "daemon"),
+	and return the number of seconds until it said it was ready
+	"""
+	start = time.time()
+	if host == "daemon":
+		subproc = DaemonSession(params.daemon_socket)
+	else:
+		subproc = start_helper(params, host)
+	try:
+		line = subproc.stdout.readline().decode()
+		elapsed = time.time() - start
+	finally:
+		subproc.stdin.close()
+		if host == "daemon":
+			subproc.kill()
+		else:
+			subproc.wait()
+	if not line.startswith("OK"):
+		raise RequesterException("Helper failed to start: " + line.strip())
+	return elapsed
+
+def launches(options):
+	"""Return the (description, host) of each way of starting the
+	helper that we can try
+	"""
+	res = []
+	if os.geteuid() == 0:
+		res.append(("local", None))
+		if options.sudo_helper:
+			sys.stderr.write("Running as root: not testing {0}\n".format(options.sudo_helper))
+	elif options.sudo_helper:
+		res.append((options.sudo_helper, None))
+	for host in options.ssh:
+		res.append(("ssh " + host, host))
+	if options.daemon_socket:
+		res.append(("daemon " + options.daemon_socket, "daemon"))
+	return res
+
+def main():
+	parser = OptionParser(usage="%prog [options]")
+	parser.add_option("-n", "--runs", action="store", type="int",
+					  dest="runs", default=5, metavar="<n>",
+					  help="Number of times to start each helper")
+	parser.add_option("-R", "--remote", action="append", dest="ssh",
+					  metavar="<host>", default=[],
+					  help="Time starting the helper on <host>")
+	parser.add_option("-s", "--sudo", action="store", dest="sudo_helper",
+					  metavar="<cmd>",
+					  help="Time starting the helper with <cmd>")
+	parser.add_option("-D", "--daemon-socket", action="store",
+					  dest="daemon_socket", metavar="<path>",
+					  help="Time attaching to the helper daemon on <path>")
+	parser.add_option("-H", "--helper", action="store", dest="helper",
+					  metavar="<path>", default="btrfs-gui-helper",
+					  help="Location of the root-helper to use")
+	(options, args) = parser.parse_args()
+	if options.runs < 1:
+		parser.error("--runs must be at least 1")
+
+	tests = launches(options)
+	if not tests:
+		sys.stderr.write("Nothing to test: run as root, or use --sudo or --remote\n")
+		sys.exit(1)
+
+	for desc, host in tests:
+		times = []
+		try:
+			for i in range(options.runs):
+				times.append(time_to_ready(options, host))
+		except (RequesterException, EnvironmentError) as ex:
+			print("{0}: failed: {1}".format(desc, ex))
+			continue
+		# The first run may have to set up an ssh connection, which
+		# the others can reuse, so it's reported separately
+		first = times[0]
+		times.sort()
+		print("{0}: first {1:.3f}s, min {2:.3f}s, median {3:.3f}s, max {4:.3f}s".format(
+			desc, first, times[0], times[len(times)//2], times[-1]))
+
+if __name__ == "__main__":
+	main()
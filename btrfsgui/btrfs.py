@@ -7,19 +7,24 @@ import struct
 import fcntl
 import array
 import itertools
+import errno
 
 MINUS_ONE = 0xffffffffffffffff
 MINUS_ONE_L = 0xffffffff
 
 # ioctl numbers
 IOC_SNAP_CREATE = 0x50009401
+IOC_SCAN_DEV = 0x50009404
 IOC_DEV_ADD = 0x5000940a
 IOC_DEV_RM = 0x5000940b
 IOC_SUBVOL_CREATE = 0x5000940e
 IOC_SNAP_DESTROY = 0x5000940f
 IOC_TREE_SEARCH = 0xd0009411
+IOC_TREE_SEARCH_V2 = 0xc0709411
 IOC_DEFAULT_SUBVOL = 0x40089413
 IOC_SPACE_INFO = 0xc0109414
+IOC_DEV_INFO = 0xd000941e
+IOC_FS_INFO = 0x8400941f
 
 # Object IDs
 ROOT_TREE_OBJECTID = 1
@@ -30,6 +35,8 @@ DEV_TREE_OBJECTID = 4
 FS_TREE_OBJECTID = 5
 ROOT_TREE_DIR_OBJECTID = 6
 CSUM_TREE_OBJECTID = 7
+QUOTA_TREE_OBJECTID = 8
+BLOCK_GROUP_TREE_OBJECTID = 11
 ORPHAN_OBJECTID = -5
 TREE_LOG_OBJECTID = -6
 TREE_LOG_FIXUP_OBJECTID = -7
@@ -45,6 +52,9 @@ DEV_ITEMS_OBJECTID = 1
 BTREE_INODE_OBJECTID = 1
 EMPTY_SUBVOL_DIR_OBJECTID = 2
 
+# Directory entry types
+FT_DIR = 2
+
 # Item keys
 INODE_ITEM_KEY = 1
 INODE_REF_KEY =	12
@@ -69,6 +79,10 @@ BLOCK_GROUP_ITEM_KEY = 192
 DEV_EXTENT_KEY = 204
 DEV_ITEM_KEY = 216
 CHUNK_ITEM_KEY = 228
+QGROUP_STATUS_KEY = 240
+QGROUP_INFO_KEY = 242
+QGROUP_LIMIT_KEY = 244
+QGROUP_RELATION_KEY = 246
 STRING_ITEM_KEY = 253
 
 # Block group flags
@@ -80,14 +94,27 @@ BLOCK_GROUP_RAID1 = 1 << 4
 BLOCK_GROUP_DUP = 1 << 5
 BLOCK_GROUP_RAID10 = 1 << 6
 
+# Quota group flags
+QGROUP_STATUS_FLAG_ON = 1 << 0
+QGROUP_STATUS_FLAG_RESCAN = 1 << 1
+QGROUP_STATUS_FLAG_INCONSISTENT = 1 << 2
+QGROUP_LIMIT_MAX_RFER = 1 << 0
+QGROUP_LIMIT_MAX_EXCL = 1 << 1
+# The level of a qgroup is in the top 16 bits of its ID. Level 0
+# qgroups are those of the subvolumes with the same ID.
+QGROUP_LEVEL_SHIFT = 48
+
 # ioctl structures
 ioctl_space_args = struct.Struct("=2Q")
 ioctl_space_info = struct.Struct("=3Q")
 ioctl_search_key = struct.Struct("=Q6QLLL4x32x")
 ioctl_search_header = struct.Struct("=3Q2L")
+ioctl_search_args_v2 = struct.Struct("=Q6QLLL4x32xQ")
 PATH_NAME_MAX=4087
 ioctl_vol_args = struct.Struct("=q4088s")
 ioctl_default_subvol = struct.Struct("=Q")
+ioctl_fs_info_args = struct.Struct("=2Q16s992x")
+ioctl_dev_info_args = struct.Struct("=Q16s2Q3032x1024s")
 
 # Internal data structures
 dev_item = struct.Struct("<3Q3L3QL2B16s16s")
@@ -95,9 +122,36 @@ dev_extent = struct.Struct("<4Q16s")
 chunk = struct.Struct("<4Q3L2H")
 stripe = struct.Struct("<2Q16s")
 block_group_item = struct.Struct("<3Q")
+# Only the generation, which follows the root directory's inode item
+root_item = struct.Struct("<160xQ")
 root_ref = struct.Struct("<2QH")
 inode_ref = struct.Struct("<QH")
 dir_item = struct.Struct("<QBQQHHB")
+qgroup_status_item = struct.Struct("<4Q")
+qgroup_info_item = struct.Struct("<5Q")
+qgroup_limit_item = struct.Struct("<5Q")
+
+# The superblock. The fixed part is followed by the dev_item for the
+# device it's on, and then the label.
+SUPER_INFO_OFFSET = 0x10000
+SUPER_INFO_SIZE = 4096
+SUPER_MAGIC = b"_BHRfS_M"
+super_block = struct.Struct("<32s16s2Q8s9Q5L4QH3B")
+SUPER_DEV_ITEM_OFFSET = super_block.size
+SUPER_LABEL_OFFSET = super_block.size + dev_item.size
+super_label = struct.Struct("<256s")
+
+_name_structs = {}
+
+def name_struct(length):
+	"""Return a (cached) structure for unpacking a name of the given
+	length, such as the tail of an inode_ref or root_ref item.
+	"""
+	try:
+		return _name_structs[length]
+	except KeyError:
+		st = _name_structs[length] = struct.Struct("{0}s".format(length))
+		return st
 
 def format_uuid(id):
 	return "{0:02x}{1:02x}{2:02x}{3:02x}-{4:02x}{5:02x}-{6:02x}{7:02x}-{8:02x}{9:02x}-{10:02x}{11:02x}{12:02x}{13:02x}{14:02x}{15:02x}".format(*struct.unpack("16B", id))
@@ -126,57 +180,234 @@ def usage_type(bgid):
 	else:
 		return ""
 
+# Tree search buffers. The whole buffer, including the search key,
+# must be at least 4096 bytes so that it can also be used with the v1
+# ioctl. The kernel won't accept more than 16 MiB of results in one go.
+SEARCH_BUF_MIN = 4096
+SEARCH_BUF_MAX = 16 * 1024 * 1024
+search_buf_size = 64 * 1024
+
+_search_buffers = []
+# Whether the kernel supports IOC_TREE_SEARCH_V2: None until we've tried
+_have_search_v2 = None
+
 def sized_array(count=4096):
 	return array.array("B", itertools.repeat(0, count))
 
-def search(fd, tree,
-		   objid, key_type, offset=[0, MINUS_ONE],
-		   transid=[0, MINUS_ONE], number=MINUS_ONE_L,
-		   structure=None, buf=None):
-	try:
-		min_objid, max_objid = objid
-	except TypeError:
-		min_objid = max_objid = objid
-	try:
-		min_type, max_type = key_type
-	except TypeError:
-		min_type = max_type = key_type
+def set_search_buffer_size(size):
+	"""Set the size of the buffers used by the tree search functions
+	when no buffer is passed to them. Buffers of the old size are
+	discarded.
+	"""
+	global search_buf_size
+	search_buf_size = max(SEARCH_BUF_MIN, min(size, SEARCH_BUF_MAX))
+	del _search_buffers[:]
+
+def get_search_buffer():
+	"""Return a tree search buffer of the configured size, reusing a
+	previously-released one if possible.
+	"""
 	try:
-		min_offset, max_offset = offset
-	except TypeError:
-		min_offset = max_offset = offset
+		return _search_buffers.pop()
+	except IndexError:
+		return sized_array(search_buf_size)
+
+def release_search_buffer(buf):
+	"""Return a buffer obtained from get_search_buffer() for reuse
+	"""
+	if len(buf) == search_buf_size:
+		_search_buffers.append(buf)
+
+try:
+	memoryview(sized_array(1))
+	def _slicer(buf):
+		"""Return a function which makes zero-copy slices of buf
+		"""
+		view = memoryview(buf)
+		return lambda pos, length: view[pos:pos+length]
+except TypeError:
+	# python 2's array doesn't support the new buffer protocol, but
+	# buffer objects will do the same job
+	def _slicer(buf):
+		"""Return a function which makes zero-copy slices of buf
+		"""
+		return lambda pos, length: buffer(buf, pos, length)
+
+class _BufferTooSmall(Exception):
+	"""The v2 search ioctl couldn't fit a single item into the buffer
+	"""
+	def __init__(self, needed):
+		self.needed = needed
+
+def _range(value):
+	"""Split a search parameter into a (min, max) pair. A single value
+	is used as both ends of the range.
+	"""
 	try:
-		min_transid, max_transid = transid
+		low, high = value
 	except TypeError:
-		min_transid = max_transid = transid
+		low = high = value
+	return low, high
+
+def _next_key(objid, key_type, offset):
+	"""Return the key immediately following (objid, key_type, offset),
+	or None if there isn't one.
+	"""
+	if offset < MINUS_ONE:
+		return (objid, key_type, offset+1)
+	if key_type < 255:
+		return (objid, key_type+1, 0)
+	if objid < MINUS_ONE:
+		return (objid+1, 0, 0)
+	return None
 
-	if buf is None:
-		buf = sized_array()
+def _search_ioctl(fd, buf, tree, min_key, max_key, transid, number):
+	"""Run a single tree search ioctl, using the v2 interface if the
+	kernel has it. Returns the number of items placed in the buffer,
+	and the offset of the first one.
+	"""
+	global _have_search_v2
+	min_transid, max_transid = _range(transid)
 	ioctl_search_key.pack_into(
 		buf, 0,
 		tree, # Tree
-		min_objid, max_objid,		# ObjectID range
-		min_offset, max_offset,		# Offset range
+		min_key[0], max_key[0],		# ObjectID range
+		min_key[2], max_key[2],		# Offset range
 		min_transid, max_transid,	# TransID range
-		min_type, max_type,			# Key type range
+		min_key[1], max_key[1],		# Key type range
 		number						# Number of items
 		)
 
-	rv = fcntl.ioctl(fd, IOC_TREE_SEARCH, buf)
-	results = ioctl_search_key.unpack_from(buf, 0)
-	num_items = results[9]
 	pos = ioctl_search_key.size
-	ret = []
-	while num_items > 0:
-		num_items =- 1
+	if _have_search_v2 is not False:
+		buf_size = len(buf) - ioctl_search_args_v2.size
+		struct.pack_into("=Q", buf, pos, buf_size)
+		try:
+			fcntl.ioctl(fd, IOC_TREE_SEARCH_V2, buf)
+			_have_search_v2 = True
+			pos = ioctl_search_args_v2.size
+		except (IOError, OSError) as ex:
+			if ex.errno == errno.EOVERFLOW:
+				_have_search_v2 = True
+				# The kernel tells us how much space the first item needs
+				raise _BufferTooSmall(struct.unpack_from("=Q", buf, pos)[0])
+			if (_have_search_v2 is not None
+				or ex.errno not in (errno.ENOTTY, errno.EINVAL)):
+				raise
+			# Old kernel: fall back to v1 from now on
+			_have_search_v2 = False
+
+	if _have_search_v2 is False:
+		fcntl.ioctl(fd, IOC_TREE_SEARCH, buf)
+
+	results = ioctl_search_key.unpack_from(buf, 0)
+	return results[9], pos
+
+def _items(buf, pos, num_items, structure, view=False):
+	"""Parse num_items search results from buf, starting at pos, and
+	yield them one at a time as (header, raw_data, data). If view is
+	set, raw_data is a view onto buf rather than a copy.
+	"""
+	if view:
+		slicer = _slicer(buf)
+	for i in range(num_items):
 		header = ioctl_search_header.unpack_from(buf, pos)
 		pos += ioctl_search_header.size
-		raw_data = buf[pos:pos+header[4]]
+		if view:
+			raw_data = slicer(pos, header[4])
+		else:
+			raw_data = buf[pos:pos+header[4]]
 		data = None
-		if structure is not None:
+		if structure is not None and header[4] >= structure.size:
 			data = structure.unpack_from(buf, pos)
 
-		ret.append((header, raw_data, data))
+		yield (header, raw_data, data)
 		pos += header[4]
 
-	return ret
+def search(fd, tree,
+		   objid, key_type, offset=[0, MINUS_ONE],
+		   transid=[0, MINUS_ONE], number=MINUS_ONE_L,
+		   structure=None, buf=None):
+	"""Run a single tree search, returning a list of (header,
+	raw_data, data) tuples for at most <number> items: as many as the
+	kernel will fit into the buffer. Use search_iter() to walk the
+	whole of a key range.
+	"""
+	min_objid, max_objid = _range(objid)
+	min_type, max_type = _range(key_type)
+	min_offset, max_offset = _range(offset)
+	min_key = (min_objid, min_type, min_offset)
+	max_key = (max_objid, max_type, max_offset)
+
+	pooled = buf is None
+	if pooled:
+		buf = get_search_buffer()
+	try:
+		try:
+			num_items, pos = _search_ioctl(fd, buf, tree, min_key, max_key,
+										   transid, number)
+		except _BufferTooSmall as ex:
+			if pooled:
+				release_search_buffer(buf)
+			pooled = False
+			buf = sized_array(ioctl_search_args_v2.size + ex.needed)
+			num_items, pos = _search_ioctl(fd, buf, tree, min_key, max_key,
+										   transid, number)
+		return list(_items(buf, pos, num_items, structure))
+	finally:
+		if pooled:
+			release_search_buffer(buf)
+
+def search_iter(fd, tree,
+				objid, key_type, offset=[0, MINUS_ONE],
+				transid=[0, MINUS_ONE],
+				structure=None, buf=None, view=False):
+	"""Walk every item in a key range of the tree, yielding (header,
+	raw_data, data) tuples as for search(). Each ioctl fetches as
+	many items as will fit in the buffer, and the next batch is only
+	requested once the previous one has been consumed. If no buffer
+	is given, one is taken from the shared pool and returned to it
+	when the iterator finishes.
+
+	As with the kernel, the (objid, key_type, offset) ranges are
+	treated as a compound key range, so items of other types may be
+	returned from the middle of it: check header[3] where it
+	matters. The buffer is reused between batches, so must not be
+	passed to any other search while the iterator is live.
+
+	If view is set, raw_data is a zero-copy view onto the search
+	buffer instead of a copy of the item. It is only valid until the
+	next item is requested.
+	"""
+	min_objid, max_objid = _range(objid)
+	min_type, max_type = _range(key_type)
+	min_offset, max_offset = _range(offset)
+
+	pooled = buf is None
+	if pooled:
+		buf = get_search_buffer()
+	try:
+		key = (min_objid, min_type, min_offset)
+		max_key = (max_objid, max_type, max_offset)
+		while key is not None and key <= max_key:
+			batch = buf
+			try:
+				num_items, pos = _search_ioctl(fd, batch, tree, key, max_key,
+											   transid, MINUS_ONE_L)
+			except _BufferTooSmall as ex:
+				# A single item larger than the buffer: fetch just that
+				# one into a buffer big enough to hold it, and go back
+				# to the usual buffer for the rest
+				batch = sized_array(ioctl_search_args_v2.size + ex.needed)
+				num_items, pos = _search_ioctl(fd, batch, tree, key, max_key,
+											   transid, 1)
+			if num_items == 0:
+				return
+
+			for item in _items(batch, pos, num_items, structure, view):
+				header = item[0]
+				yield item
+			key = _next_key(header[1], header[3], header[2])
+	finally:
+		if pooled:
+			release_search_buffer(buf)
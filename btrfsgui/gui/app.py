@@ -11,20 +11,36 @@ from btrfsgui.gui.usagedisplay import UsageDisplay
 from btrfsgui.gui.subvolumes import Subvolumes
 from btrfsgui.gui.mkfs import MkfsDialog
 from btrfsgui.gui.devices import DeviceListDialogue
-from btrfsgui.requester import Requester, ex_handler
+from btrfsgui.requester import Requester, CancelToken, ex_handler
+
+# How often to check for replies to asynchronous requests, in ms
+POLL_INTERVAL = 50
 
 class Application(Frame, Requester):
-	def __init__(self, comms, options):
+	def __init__(self, sessions, options):
 		Frame.__init__(self, None)
-		Requester.__init__(self, comms)
+		# Requests go to the host of the selected filesystem
+		self.sessions = sessions
+		self.host = sessions.hosts[0]
+		Requester.__init__(self, sessions.get(self.host))
 
 		self.options = options
 		self.selected_fs = None
+		self.filesystems = []
+		# Cancelled when the selection changes, to abandon prefetching
+		# for the old one
+		self.token = CancelToken()
+		# The tabs, most recently shown last
+		self.tab_history = []
+		# With more than one host, the filesystem list has a level for
+		# the hosts
+		self.multi_host = len(sessions.hosts) > 1
 
 		self.grid(sticky=N+S+E+W)
 		self.set_styles()
 		self.create_widgets()
 		self.master.title("btrfs GUI")
+		self.poll_helper()
 
 	def set_styles(self):
 		self.style = style = Style()
@@ -41,6 +57,11 @@ class Application(Frame, Requester):
 		self.LRpane = PanedWindow(self, orient=HORIZONTAL)
 		self.LRpane.grid(sticky=N+S+E+W)
 
+		# Shows that we're waiting for the helper
+		self.progress = Progressbar(self, mode="indeterminate")
+		self.progress.grid(row=1, sticky=E)
+		self.progress_running = False
+
 		self.sidebar = PanedWindow(self.LRpane, orient=VERTICAL)
 		self.LRpane.add(self.sidebar)
 		self.datapane = Notebook(self.LRpane)
@@ -60,6 +81,7 @@ class Application(Frame, Requester):
 		self.sidebar.add(fs_frame)
 		self.fs_list.bind("<Double-Button-1>", self.select_fs)
 		self.fs_list.bind("<Button-3>", self.fs_context_menu)
+		self.fs_list.bind("<<TreeviewOpen>>", self.open_host)
 
 		self.images = { "fs": image_or_blank(file="img/fs_icon.gif"),
 						"fs-sel": image_or_blank(file="img/fs_icon_open.gif"),
@@ -67,10 +89,22 @@ class Application(Frame, Requester):
 		self.fs_list.tag_configure("fs", image=self.images["fs"])
 		self.fs_list.tag_configure("dev", image=self.images["dev"])
 
+		if self.multi_host:
+			for i, host in enumerate(self.sessions.hosts):
+				iid = self.host_iid(host)
+				self.fs_list.insert("", "end", iid=iid,
+									text=host or "localhost",
+									tags=["host",], open=False)
+				# Placeholder, so that the host can be opened to
+				# connect to it
+				self.fs_list.insert(iid, "end", iid=iid + "/...",
+									text="...")
+
 		self.usage = UsageDisplay(self.datapane, self.comms)
 		self.datapane.add(self.usage, text="Space Usage", sticky="nsew")
 		self.subvols = Subvolumes(self.datapane, self.comms)
 		self.datapane.add(self.subvols, text="Subvolumes", sticky="nsew")
+		self.datapane.bind("<<NotebookTabChanged>>", self.tab_changed)
 
 		self.create_menus(top)
 
@@ -105,33 +139,130 @@ class Application(Frame, Requester):
 			except AttributeError:
 				pass
 
-	def select_fs(self, event):
-		"""Select a filesystem by double-clicking on it, or any of its
-		devices
+	def poll_helper(self):
+		"""Deliver any replies from the helpers, and show whether we're
+		still waiting for more
 		"""
-		rowid = self.fs_list.identify_row(event.y)
-		if rowid.find(":") != -1:
+		busy = False
+		for comms in list(self.sessions.sessions.values()):
+			comms.dispatch()
+			busy = busy or comms.busy() > 0
+		if busy and not self.progress_running:
+			self.progress.start()
+		elif not busy and self.progress_running:
+			self.progress.stop()
+		self.progress_running = busy
+		self.after(POLL_INTERVAL, self.poll_helper)
+
+	def host_iid(self, host):
+		"""The row ID of a host in the filesystem list
+		"""
+		return "host{0}".format(self.sessions.hosts.index(host))
+
+	def fs_iid(self, host, uuid):
+		"""The row ID of a filesystem in the filesystem list
+		"""
+		if self.multi_host:
+			return "{0}/{1}".format(self.host_iid(host), uuid)
+		return uuid
+
+	def row_fs(self, rowid):
+		"""Return the filesystem shown in a row of the filesystem list,
+		or the filesystem of the device shown there
+		"""
+		if "dev" in self.fs_list.item(rowid, "tags"):
 			rowid = self.fs_list.parent(rowid)
 		for afs in self.filesystems:
-			if afs["uuid"] == rowid:
-				self.set_selected(afs)
+			if afs["iid"] == rowid:
+				return afs
+		return None
+
+	@ex_handler
+	def open_host(self, event):
+		"""Connect to a host and scan it when it's first opened in the
+		filesystem list
+		"""
+		rowid = self.fs_list.focus()
+		if "host" not in self.fs_list.item(rowid, "tags"):
+			return
+		if not self.fs_list.exists(rowid + "/..."):
+			return
+		for host in self.sessions.hosts:
+			if self.host_iid(host) == rowid:
+				self.sessions.get(host)
+				self.scan_host(host)
 				break
 
+	def select_fs(self, event):
+		"""Select a filesystem by double-clicking on it, or any of its
+		devices
+		"""
+		afs = self.row_fs(self.fs_list.identify_row(event.y))
+		if afs is not None:
+			self.set_selected(afs)
+
 	def set_selected(self, fs):
 		"""Set the given selection in the UI
 		"""
 		self.selected_fs = None
 
 		for afs in self.filesystems:
-			# The row ID is the UUID of the filesystem
-			if afs["uuid"] == fs["uuid"]:
+			if afs["iid"] == fs["iid"]:
 				self.selected_fs = afs
-				self.fs_list.item(afs["uuid"], image=self.images["fs-sel"])
+				self.fs_list.item(afs["iid"], image=self.images["fs-sel"])
 			else:
-				self.fs_list.item(afs["uuid"], image=self.images["fs"])
+				self.fs_list.item(afs["iid"], image=self.images["fs"])
 
+		# Talk to the selected filesystem's host from now on. Its
+		# session is kept in the pool, so switching is cheap.
+		if self.selected_fs is not None:
+			self.host = self.selected_fs["host"]
+			self.comms = self.sessions.get(self.host)
+		# Only the tab on show fetches its data now. The others are
+		# left stale until they're shown, or prefetched.
+		self.token.cancel()
+		self.token = CancelToken()
 		for w in self.datapane.tabs():
-			self.nametowidget(w).set_selected(self.selected_fs)
+			tab = self.nametowidget(w)
+			tab.comms = self.comms
+			tab.set_selected(self.selected_fs)
+		self.tab_changed(None)
+
+	def tab_changed(self, event):
+		"""Bring the tab now on show up to date, and then prefetch
+		the data for the one likely to be shown next
+		"""
+		tab = self.nametowidget(self.datapane.select())
+		if tab in self.tab_history:
+			self.tab_history.remove(tab)
+		self.tab_history.append(tab)
+		tab.update_display(token=self.token)
+		self.prefetch(self.token)
+
+	def likely_tab(self):
+		"""Guess which tab will be shown next: the one shown before
+		the current one, or else the next one along
+		"""
+		if len(self.tab_history) > 1:
+			return self.tab_history[-2]
+		tabs = self.datapane.tabs()
+		pos = self.datapane.index("current") + 1
+		if pos < len(tabs):
+			return self.nametowidget(tabs[pos])
+		return None
+
+	def prefetch(self, token):
+		"""Fetch the data for the tab likely to be shown next, once the
+		helper has finished with the one on show
+		"""
+		if token.cancelled:
+			return
+		if self.comms.busy() > 0:
+			self.after(POLL_INTERVAL, self.prefetch, token)
+			return
+		tab = self.likely_tab()
+		if tab is not None:
+			tab.update_display(token=token)
 
 	def new_filesystem(self):
 		"""Create a new filesystem
@@ -142,17 +273,38 @@ class Application(Frame, Requester):
 
 	@ex_handler
 	def scan(self):
-		self.fs_list.delete(*self.fs_list.get_children())
-		rv, text, obj = self.request("scan")
-		self.filesystems = obj
+		"""Scan for filesystems on all the hosts we're connected to
+		"""
+		for host in self.sessions.hosts:
+			if self.sessions.connected(host):
+				self.scan_host(host)
+
+	def scan_host(self, host):
+		Requester(self.sessions.get(host)).request_async(
+			lambda rv, text, obj: self.show_filesystems(host, obj),
+			"scan")
+
+	def show_filesystems(self, host, obj):
+		"""Fill in the filesystem list from the results of a scan of
+		one host
+		"""
+		parent = ""
+		if self.multi_host:
+			parent = self.host_iid(host)
+			self.fs_list.item(parent, open=True)
+		self.fs_list.delete(*self.fs_list.get_children(parent))
+		self.filesystems = [afs for afs in self.filesystems
+							if afs["host"] != host] + obj
 
 		for fs in obj:
+			fs["host"] = host
+			fs["iid"] = self.fs_iid(host, fs["uuid"])
 			lbl = fs["label"]
 			if lbl is None:
 				lbl = "(unlabelled)"
 			iid = self.fs_list.insert(
-				"", "end",
-				iid=fs["uuid"],
+				parent, "end",
+				iid=fs["iid"],
 				text=lbl,
 				values=(fs["uuid"],),
 				tags=["fs",],
@@ -161,8 +313,8 @@ class Application(Frame, Requester):
 			fs["vols"].sort(key=lambda x: x["path"])
 			for vol in fs["vols"]:
 				iid = self.fs_list.insert(
-					fs["uuid"], "end",
-					iid="{0}:{1}".format(fs["uuid"], vol["id"]),
+					fs["iid"], "end",
+					iid="{0}:{1}".format(fs["iid"], vol["id"]),
 					text=vol["path"],
 					tags=["dev",],
 					image=self.images["dev"])
@@ -181,43 +333,44 @@ class Application(Frame, Requester):
 		pop up a suitable context menu for it.
 		"""
 		rowid = self.fs_list.identify_row(ev.y)
-		if rowid == "":
+		afs = self.row_fs(rowid)
+		if afs is None:
 			return
 
 		ctx_menu = Menu(self, tearoff=False)
 
-		if rowid.find(":") != -1:
+		if "dev" in self.fs_list.item(rowid, "tags"):
 			# User clicked on a device
-			fsid = self.fs_list.parent(rowid)
-			devid = rowid.split(":", 1)[1]
 			device = self.fs_list.item(rowid, "text")
 			ctx_menu.add_command(
 				label="Remove",
-				command=lambda: self.remove_device(fsid, device))
+				command=lambda: self.remove_device(afs, device))
 		else:
 			# User clicked on a filesystem
 			ctx_menu.add_command(
 				label="Add device",
-				command=lambda: self.add_device(rowid))
+				command=lambda: self.add_device(afs))
 
 		ctx_menu.bind("<FocusOut>", lambda e: ctx_menu.unpost())
 		ctx_menu.post(ev.x_root, ev.y_root)
 		ctx_menu.focus_set()
 
 	@ex_handler
-	def remove_device(self, fsid, device):
+	def remove_device(self, fs, device):
 		"""Remove a device from a filesystem
 		"""
 		# FIXME: Check whether there's an obvious fail on disk size
 		# and stop the user from doing it.
-		rv, text, obj = self.request("rm_dev", fsid, device)
+		host = Requester(self.sessions.get(fs["host"]))
+		rv, text, obj = host.request("rm_dev", fs["uuid"], device)
 
 	@ex_handler
-	def add_device(self, fsid):
+	def add_device(self, fs):
 		"""Add a device to a filesystem
 		"""
 		# Open up a dialogue window and do the work inside that
-		dialogue = DeviceListDialogue(self, self.comms)
+		host = Requester(self.sessions.get(fs["host"]))
+		dialogue = DeviceListDialogue(self, host.comms)
 		if dialogue.result is not None:
 			devname = dialogue.result[0]["cname"]
-			rv, text, obj = self.request("add_dev", fsid, devname)
+			rv, text, obj = host.request("add_dev", fs["uuid"], devname)
@@ -9,6 +9,24 @@ import tkinter.messagebox
 
 _icon_warned = False
 
+_size_units = ["B", "KiB", "MiB", "GiB", "TiB", "PiB", "EiB"]
+
+def format_size(size):
+	"""Format a number of bytes for display, in binary units
+	"""
+	if size is None:
+		return ""
+	value = float(size)
+	for unit in _size_units[:-1]:
+		if abs(value) < 1024:
+			break
+		value /= 1024
+	else:
+		unit = _size_units[-1]
+	if unit == "B":
+		return "{0} B".format(int(size))
+	return "{0:.1f} {1}".format(value, unit)
+
 def image_or_blank(file):
 	"""Find and return a tkinter image that can be used as an icon
 	"""
@@ -26,7 +44,11 @@ def image_or_blank(file):
 """Scrolled helpers shamelessly lifted from Frederik Lundh at
 http://effbot.org/zone/tkinter-scrollbar-patterns.htm
 """
-def Scrolled(_widget, _master, _mode='y', **options):
+def Scrolled(_widget, _master, _mode='y', _yscrolled=None, **options):
+	"""Wrap a widget in a frame with scrollbars. If given, _yscrolled
+	is called with the (first, last) visible fractions of the widget
+	whenever it scrolls vertically.
+	"""
 	frame = Frame(_master, relief=SUNKEN)
 	frame.rowconfigure(0, weight=1)
 	frame.columnconfigure(0, weight=1)
@@ -42,7 +64,13 @@ def Scrolled(_widget, _master, _mode='y', **options):
 		xscrollbar.grid(row=1, column=0, sticky=E+W)
 	if 'y' in _mode:
 		yscrollbar = Scrollbar(frame)
-		widget.config(yscrollcommand=yscrollbar.set)
+		if _yscrolled is None:
+			widget.config(yscrollcommand=yscrollbar.set)
+		else:
+			def yscroll(first, last):
+				yscrollbar.set(first, last)
+				_yscrolled(first, last)
+			widget.config(yscrollcommand=yscroll)
 		yscrollbar.config(command=widget.yview)
 		yscrollbar.grid(row=0, column=1, sticky=N+S)
 	return (frame, widget)
@@ -58,3 +86,402 @@ def ScrolledText(master, _mode='y', **options):
 
 def ScrolledCanvas(master, _mode='xy', **options):
 	return Scrolled(Canvas, master, _mode, **options)
+
+class _VirtualNode(object):
+	"""An item in a VirtualTreeview, whether or not it's on screen
+	"""
+	__slots__ = ("parent", "children", "text", "image", "values",
+				 "tags", "open")
+
+	def __init__(self, parent, text="", image="", values=(), tags=(),
+				 open=False):
+		self.parent = parent
+		self.children = []
+		self.text = text
+		self.image = image
+		self.values = list(values)
+		self.tags = tags
+		self.open = open
+
+class VirtualTreeview(Frame):
+	"""A scrolled Treeview which only creates Treeview items for the
+	rows on screen. The rest of the tree is kept as a model, so that
+	lists of tens of thousands of items cost no more to display than
+	a screenful. Ancestors of the top row are always shown, above it,
+	so that the rows' parents stay in view.
+
+	It implements the parts of the Treeview interface used in this
+	program, with the same meanings. Events are bound on the real
+	Treeview inside, which only knows about the items on screen.
+	"""
+	# Rows scrolled by a turn of the mouse wheel
+	WHEEL_ROWS = 3
+
+	def __init__(self, master, yscrolled=None, **options):
+		Frame.__init__(self, master, relief=SUNKEN)
+		self.rowconfigure(0, weight=1)
+		self.columnconfigure(0, weight=1)
+		self.tree = Treeview(self, **options)
+		self.tree.grid(row=0, column=0, sticky=N+S+E+W)
+		self.scrollbar = Scrollbar(self, command=self.yview)
+		self.scrollbar.grid(row=0, column=1, sticky=N+S)
+		self.yscrolled = yscrolled
+
+		self.columns = list(options.get("columns", []))
+		self.nodes = {"": _VirtualNode(None, open=True)}
+		self.next_iid = 0
+		self.selected = []
+		self.focus_item = ""
+		# The visible (not inside a closed item) rows, in order, or
+		# None when the tree has changed since they were worked out
+		self.flat = None
+		self.top = 0
+		self.displayed = set()
+		self.pending = None
+		# Until we can measure them
+		self.rows = 1
+		self.rowheight = 20
+		self.heading_height = 0
+		self.height = 0
+
+		# Our own bindings come before the Treeview's, so that we can
+		# take over scrolling
+		tag = str(self) + "-virtual"
+		tags = list(self.tree.bindtags())
+		tags.insert(tags.index("Treeview"), tag)
+		self.tree.bindtags(tuple(tags))
+		self.tree.bind_class(tag, "<Configure>", self._resized)
+		self.tree.bind_class(tag, "<<TreeviewSelect>>", self._selected)
+		self.tree.bind_class(tag, "<<TreeviewOpen>>",
+							 lambda e: self._opened(True))
+		self.tree.bind_class(tag, "<<TreeviewClose>>",
+							 lambda e: self._opened(False))
+		self.tree.bind_class(tag, "<Button-4>", self._wheel)
+		self.tree.bind_class(tag, "<Button-5>", self._wheel)
+		self.tree.bind_class(tag, "<MouseWheel>", self._wheel)
+		self.tree.bind_class(tag, "<Up>", lambda e: self._step(-1))
+		self.tree.bind_class(tag, "<Down>", lambda e: self._step(1))
+		self.tree.bind_class(tag, "<Prior>", lambda e: self._step(-self.rows))
+		self.tree.bind_class(tag, "<Next>", lambda e: self._step(self.rows))
+
+	# The model
+
+	def insert(self, parent, index, iid=None, **kw):
+		if iid is None:
+			self.next_iid += 1
+			iid = "V{0:X}".format(self.next_iid)
+		if iid in self.nodes:
+			raise TclError("Item {0} already exists".format(iid))
+		self.nodes[iid] = _VirtualNode(parent, **kw)
+		self._attach(iid, parent, index)
+		self._changed()
+		return iid
+
+	def _attach(self, iid, parent, index):
+		children = self.nodes[parent].children
+		if index == "end":
+			children.append(iid)
+		else:
+			children.insert(int(index), iid)
+		self.nodes[iid].parent = parent
+
+	def delete(self, *items):
+		"""Delete items and all their descendants. Many items can be
+		deleted at once, at little more cost than one.
+		"""
+		parents = set()
+		for iid in items:
+			if iid not in self.nodes:
+				# Already gone with an ancestor
+				continue
+			parents.add(self.nodes[iid].parent)
+			stack = [iid]
+			while stack:
+				node = self.nodes.pop(stack.pop())
+				stack.extend(node.children)
+		for parent in parents:
+			if parent in self.nodes:
+				node = self.nodes[parent]
+				node.children = [c for c in node.children if c in self.nodes]
+		self.selected = [i for i in self.selected if i in self.nodes]
+		if self.focus_item not in self.nodes:
+			self.focus_item = ""
+		self._changed()
+
+	def set_children(self, item, *newchildren):
+		"""Replace the children of item. Reordering the existing
+		children, as when sorting, takes a single pass.
+		"""
+		keep = set(newchildren)
+		self.delete(*[c for c in self.nodes[item].children if c not in keep])
+		for iid in newchildren:
+			node = self.nodes[iid]
+			if node.parent != item:
+				self.nodes[node.parent].children.remove(iid)
+				node.parent = item
+		self.nodes[item].children = list(newchildren)
+		self._changed()
+
+	def move(self, item, parent, index):
+		old = self.nodes[self.nodes[item].parent]
+		old.children.remove(item)
+		self._attach(item, parent, index)
+		self._changed()
+
+	def exists(self, item):
+		return item in self.nodes
+
+	def parent(self, item):
+		return self.nodes[item].parent
+
+	def get_children(self, item=""):
+		return tuple(self.nodes[item].children)
+
+	def item(self, item, option=None, **kw):
+		node = self.nodes[item]
+		if option is not None:
+			return getattr(node, option)
+		if not kw:
+			return dict((name, getattr(node, name)) for name in
+						("text", "image", "values", "tags", "open"))
+		for name, value in kw.items():
+			if name == "values":
+				value = list(value)
+			setattr(node, name, value)
+		if "open" in kw:
+			self._changed()
+		else:
+			self._schedule()
+
+	def set(self, item, column, value=None):
+		values = self.nodes[item].values
+		col = self.columns.index(column)
+		if value is None:
+			if col < len(values):
+				return values[col]
+			return ""
+		values.extend([""] * (col + 1 - len(values)))
+		values[col] = value
+		self._schedule()
+
+	def focus(self, item=None):
+		if item is None:
+			current = self.tree.focus()
+			if current in self.nodes:
+				self.focus_item = current
+			return self.focus_item
+		self.focus_item = item
+		self._schedule()
+
+	def selection(self):
+		return tuple(self.selected)
+
+	def selection_set(self, *items):
+		if len(items) == 1 and isinstance(items[0], (list, tuple)):
+			items = items[0]
+		# The root isn't a row, so can't be selected
+		self.selected = [i for i in items if i != "" and i in self.nodes]
+		self._schedule()
+
+	def see(self, item):
+		"""Open the item's ancestors, and scroll it into view
+		"""
+		parent = self.nodes[item].parent
+		while parent != "":
+			if not self.nodes[parent].open:
+				self.nodes[parent].open = True
+				self.flat = None
+			parent = self.nodes[parent].parent
+		pos = self._flatten().index(item)
+		if pos < self.top:
+			self.top = pos
+		else:
+			shown = max(1, self.rows - self._depth(item))
+			if pos >= self.top + shown:
+				self.top = pos - shown + 1
+		self._schedule()
+
+	# Passed through to the Treeview
+
+	def bind(self, sequence=None, func=None, add=None):
+		return self.tree.bind(sequence, func, add)
+
+	def heading(self, column, option=None, **kw):
+		return self.tree.heading(column, option, **kw)
+
+	def column(self, column, option=None, **kw):
+		return self.tree.column(column, option, **kw)
+
+	def identify_row(self, y):
+		return self.tree.identify_row(y)
+
+	def bbox(self, item, column=None):
+		"""The item's bounding box, or "" if it's not on screen
+		"""
+		if item not in self.displayed:
+			return ""
+		return self.tree.bbox(item, column)
+
+	# Scrolling
+
+	def yview(self, *args):
+		"""Scrollbar command
+		"""
+		if args[0] == "moveto":
+			self.top = int(float(args[1]) * len(self._flatten()))
+		elif args[2] == "pages":
+			self.top += int(args[1]) * self.rows
+		else:
+			self.top += int(args[1])
+		self._render()
+
+	def _wheel(self, ev):
+		if ev.num == 4 or ev.delta > 0:
+			self.top -= self.WHEEL_ROWS
+		else:
+			self.top += self.WHEEL_ROWS
+		self._render()
+		return "break"
+
+	def _step(self, step):
+		"""Move the focus and selection by <step> rows
+		"""
+		flat = self._flatten()
+		if flat:
+			try:
+				pos = flat.index(self.focus()) + step
+			except ValueError:
+				pos = 0
+			item = flat[max(0, min(pos, len(flat)-1))]
+			self.focus(item)
+			self.selection_set(item)
+			self.see(item)
+			self.tree.event_generate("<<TreeviewSelect>>")
+		return "break"
+
+	def _resized(self, ev):
+		self.height = ev.height
+		self._measure()
+
+	def _measure(self):
+		"""Work out how many rows fit in the widget, and redraw if it's
+		changed
+		"""
+		rows = max(1, (self.height - self.heading_height) // self.rowheight)
+		if rows != self.rows:
+			self.rows = rows
+			self._schedule()
+
+	# Keeping the Treeview up to date
+
+	def _selected(self, ev):
+		"""The user has changed the selection among the rows on screen
+		"""
+		shown = [i for i in self.tree.selection() if i in self.nodes]
+		self.selected = [i for i in self.selected
+						 if i not in self.displayed] + shown
+		self.focus()
+
+	def _opened(self, state):
+		item = self.tree.focus()
+		if item in self.nodes:
+			self.nodes[item].open = state
+			self._changed()
+
+	def _changed(self):
+		self.flat = None
+		self._schedule()
+
+	def _schedule(self):
+		"""Redraw when idle, however many changes are made before then
+		"""
+		if self.pending is None:
+			self.pending = self.after_idle(self._render)
+
+	def _flatten(self):
+		if self.flat is None:
+			flat = []
+			stack = list(reversed(self.nodes[""].children))
+			while stack:
+				iid = stack.pop()
+				flat.append(iid)
+				node = self.nodes[iid]
+				if node.open:
+					stack.extend(reversed(node.children))
+			self.flat = flat
+		return self.flat
+
+	def _ancestors(self, item):
+		res = []
+		parent = self.nodes[item].parent
+		while parent != "":
+			res.insert(0, parent)
+			parent = self.nodes[parent].parent
+		return res
+
+	def _depth(self, item):
+		return len(self._ancestors(item))
+
+	def _render(self):
+		"""Replace the Treeview's items with the rows now on screen
+		"""
+		if self.pending is not None:
+			self.after_cancel(self.pending)
+			self.pending = None
+		flat = self._flatten()
+
+		# Don't scroll past the end: the last row must fit on screen
+		# below the ancestors of the top row
+		last = max(0, len(flat) - self.rows)
+		while last < len(flat) - 1 and \
+			  last + self.rows - self._depth(flat[last]) < len(flat):
+			last += 1
+		self.top = max(0, min(self.top, last))
+
+		if flat:
+			above = self._ancestors(flat[self.top])
+			shown = max(1, self.rows - len(above))
+			window = flat[self.top:self.top+shown]
+		else:
+			above = window = []
+
+		self.displayed = set(above + window)
+		self.tree.delete(*self.tree.get_children())
+		for iid in above + window:
+			node = self.nodes[iid]
+			self.tree.insert(node.parent, "end", iid=iid, text=node.text,
+							 image=node.image, values=node.values,
+							 tags=node.tags, open=node.open)
+			if node.children and (not node.open or iid == window[-1]):
+				# Give it an expander, even though its children are
+				# off-screen
+				self.tree.insert(iid, "end", text="")
+		self.tree.selection_set([i for i in self.selected
+								 if i in self.displayed])
+		if self.focus_item in self.displayed:
+			self.tree.focus(self.focus_item)
+
+		if flat:
+			first = float(self.top) / len(flat)
+			end = min(1.0, float(self.top + len(window)) / len(flat))
+		else:
+			first, end = 0.0, 1.0
+		self.scrollbar.set(first, end)
+
+		# Now we have a row, see how big it is
+		if window:
+			bbox = self.tree.bbox(window[0])
+			if bbox:
+				self.rowheight = max(1, bbox[3])
+				self.heading_height = bbox[1] - bbox[3] * len(above)
+				self._measure()
+
+		if self.yscrolled is not None:
+			self.yscrolled(first, end)
+
+def ScrolledVirtualTreeview(master, _yscrolled=None, **options):
+	"""A VirtualTreeview, in the same form as the Scrolled helpers.
+	The widget has its own scrollbar, so it is its own frame.
+	"""
+	widget = VirtualTreeview(master, yscrolled=_yscrolled, **options)
+	return (widget, widget)
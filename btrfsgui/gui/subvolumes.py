@@ -6,10 +6,15 @@ import tkinter.messagebox
 import tkinter.simpledialog
 import os.path
 
-from btrfsgui.gui.lib import image_or_blank, ScrolledTreeview
-from btrfsgui.requester import Requester, ex_handler
+from btrfsgui.gui.lib import image_or_blank, ScrolledVirtualTreeview, format_size
+from btrfsgui.requester import Requester, ex_handler, report_error
 import btrfsgui.btrfs as btrfs
 
+# Number of directory entries to fetch at a time
+LS_PAGE = 500
+# Columns of the subvolume list showing sizes from the quota tree
+SIZE_COLUMNS = ["referenced", "exclusive"]
+
 def current_selection(fn):
 	"""Decorator to retrieve and set the current selection and
 	pass its details to the decorated method
@@ -33,6 +38,16 @@ class Subvolumes(Frame, Requester):
 		Frame.__init__(self, parent)
 		Requester.__init__(self, comms)
 
+		self.fs = None
+		self.stale = False
+		self.subvols = {}
+		self.generation = 0
+		self.default = None
+		# Subvolume ID -> (referenced, exclusive) bytes, from the
+		# quota tree
+		self.sizes = {}
+		self.sort_column = None
+		self.sort_reverse = False
 		self.create_widgets()
 
 	def create_top_menus(self, parent):
@@ -57,10 +72,15 @@ class Subvolumes(Frame, Requester):
 		self.columnconfigure(0, weight=1)
 		self.rowconfigure(0, weight=1)
 
-		frame, self.sv_list = ScrolledTreeview(self, columns=["name", "id"])
+		frame, self.sv_list = ScrolledVirtualTreeview(
+			self, columns=["name", "id", "referenced", "exclusive"])
 		self.sv_list.heading("#0", text="path", anchor="w")
 		self.sv_list.heading("id", text="id", anchor="w")
 		self.sv_list.heading("name", text="name", anchor="w")
+		for column in SIZE_COLUMNS:
+			self.sv_list.heading(column, text=column, anchor="e",
+								 command=lambda c=column: self.sort_by(c))
+			self.sv_list.column(column, anchor="e")
 		frame.grid(sticky=N+S+W+E)
 
 		self.ctx_menu = Menu(self, tearoff=False)
@@ -129,52 +149,162 @@ class Subvolumes(Frame, Requester):
 		"""Set the current selection to be the default subvolume
 		"""
 		rv, text, obj = self.request("sub_def", self.fs["uuid"], vol_id)
-		self.update_display()
+		self.change_display()
 
 	def set_selected(self, fs):
 		"""Pass parameters for the basic FS information so that we
-		know how to get the relevant information from the helper.
+		know how to get the relevant information from the helper. It
+		isn't fetched until update_display() is called, when the tab
+		is shown.
 		"""
+		if fs is None or self.fs is None or fs["uuid"] != self.fs["uuid"]:
+			# A different filesystem: start the list from scratch
+			self.sv_list.delete(*self.sv_list.get_children())
+			self.subvols = {}
+			self.generation = 0
+			self.default = None
+			self.sizes = {}
 		self.fs = fs
 		self.stale = True
-		self.update_display()
 
 	def change_display(self):
 		self.stale = True
 		self.update_display()
 
 	@ex_handler
-	def update_display(self):
-		if not self.stale:
+	def update_display(self, token=None):
+		"""Fetch and show the subvolumes, if they may have changed
+		since we last did. Requests made on behalf of a prefetch pass
+		its CancelToken.
+		"""
+		if not self.stale or self.fs is None:
 			return
-
-		# Clean up the existing display
-		self.sv_list.delete(*self.sv_list.get_children())
-
-		# Get the list of subvolumes, and populate the display
-		rv, text, self.subvols = self.request("sub_list", self.fs["uuid"])
-
-		self.sv_list.insert("", "end", text="@", iid="@", values=["0", ""],
-							open=True, image=self.img["subv"])
-
-		def_set = False
-		for subv in sorted(self.subvols.values(), key=lambda x: len(x["full_path"])):
+		self.stale = False
+
+		# Get the subvolumes which have changed since we last looked,
+		# and all their sizes, and patch the display with them when
+		# they arrive
+		fs = self.fs
+		self.request_all_async(
+			lambda results: self.show_subvolumes(fs, results[0][2],
+												 results[1][2]),
+			("sub_list_since", fs["uuid"], self.generation),
+			("qgroups", fs["uuid"]),
+			errback=lambda ex: self.fetch_failed(fs, ex),
+			token=token)
+
+	def fetch_failed(self, fs, ex):
+		"""Report a failed fetch, and try again next time
+		"""
+		if fs is self.fs:
+			self.stale = True
+		if not report_error(ex):
+			raise ex
+
+	def show_subvolumes(self, fs, obj, quotas):
+		"""Update the list with the results of sub_list_since and
+		qgroups for fs
+		"""
+		if fs is not self.fs:
+			# The selection has changed since we asked
+			return
+		self.generation = obj["generation"]
+
+		if not self.sv_list.exists("@"):
+			self.sv_list.insert("", "end", text="@", iid="@",
+								values=["0", ""],
+								open=True, image=self.img["subv"])
+
+		# Remove the subvolumes which have gone away. JSON object keys
+		# are always strings, so we use strings throughout.
+		present = set(str(sv_id) for sv_id in obj["ids"])
+		for sv_id in list(self.subvols.keys()):
+			if sv_id not in present:
+				del self.subvols[sv_id]
+				self.sv_list.delete(sv_id)
+
+		changed = obj["subvols"]
+		for subv in sorted(changed.values(), key=lambda x: len(x["full_path"])):
+			sv_id = str(subv["id"])
+			self.subvols[sv_id] = subv
 			path = os.path.join(*(subv["full_path"] + [subv["name"]]))
-			img = self.img["subv"]
-			if subv.get("default", False):
-				def_set = True
-				img = self.img["subv-def"]
-			self.sv_list.insert(
-				"@",
-				"end",
-				text=path,
-				iid=subv["id"],
-				values=[subv["name"], subv["id"]],
-				open=True,
-				image=img)
-
-		if not def_set:
-			self.sv_list.item("@", image=self.img["subv-def"])
+			if self.sv_list.exists(sv_id):
+				self.sv_list.item(sv_id, text=path)
+				self.sv_list.set(sv_id, "name", subv["name"])
+				self.sv_list.set(sv_id, "id", subv["id"])
+			else:
+				self.sv_list.insert(
+					"@",
+					"end",
+					text=path,
+					iid=sv_id,
+					values=[subv["name"], subv["id"], "", ""],
+					open=True)
+
+		# Mark the default subvolume, and unmark the old one
+		default = obj["default"]
+		if default is None or str(default) not in self.subvols:
+			default = "@"
+		else:
+			default = str(default)
+		for iid in [str(k) for k in changed.keys()] + [self.default, default]:
+			if iid is not None and self.sv_list.exists(iid):
+				if iid == default:
+					self.sv_list.item(iid, image=self.img["subv-def"])
+				else:
+					self.sv_list.item(iid, image=self.img["subv"])
+		self.default = default
+
+		self.show_sizes(quotas)
+
+	def show_sizes(self, quotas):
+		"""Fill in the sizes of the subvolumes from the results of
+		qgroups. Without quotas, there are no sizes to show.
+		"""
+		self.sizes = {}
+		for sv_id, group in quotas["qgroups"].items():
+			self.sizes[sv_id] = (group["referenced"], group["exclusive"])
+		# The top level is shown as @, but its qgroup has its ID
+		self.sizes["@"] = self.sizes.pop(str(btrfs.FS_TREE_OBJECTID),
+										 (None, None))
+
+		for iid in ["@"] + list(self.subvols.keys()):
+			sizes = self.sizes.get(iid, (None, None))
+			for column, size in zip(SIZE_COLUMNS, sizes):
+				self.sv_list.set(iid, column, format_size(size))
+		self.sort_subvolumes()
+
+	def sort_by(self, column):
+		"""Sort the subvolumes by a size column, biggest first, or the
+		other way round if they're already sorted by it
+		"""
+		if self.sort_column == column:
+			self.sort_reverse = not self.sort_reverse
+		else:
+			self.sort_column = column
+			self.sort_reverse = False
+		for col in SIZE_COLUMNS:
+			text = col
+			if col == column:
+				text += " \u25b2" if self.sort_reverse else " \u25bc"
+			self.sv_list.heading(col, text=text)
+		self.sort_subvolumes()
+
+	def sort_subvolumes(self):
+		"""Put the subvolumes in the order chosen by sort_by(). Those
+		without a size count as the smallest.
+		"""
+		if self.sort_column is None or not self.sv_list.exists("@"):
+			return
+		col = SIZE_COLUMNS.index(self.sort_column)
+		def key(iid):
+			size = self.sizes.get(iid, (None, None))[col]
+			if size is None:
+				return -1
+			return size
+		ids = sorted(self.sv_list.get_children("@"), key=key,
+					 reverse=not self.sort_reverse)
+		self.sv_list.set_children("@", *ids)
 
 
 class NewSubvolume(tkinter.simpledialog.Dialog):
@@ -185,6 +315,9 @@ class NewSubvolume(tkinter.simpledialog.Dialog):
 		self.uuid = uuid
 		self.result = False
 		self.source = source
+		# "More..." rows standing in for the unfetched parts of large
+		# directories: iid -> (parentid, dirname, cursor)
+		self.more = {}
 		tkinter.simpledialog.Dialog.__init__(self, parent)
 
 	@ex_handler
@@ -210,8 +343,9 @@ class NewSubvolume(tkinter.simpledialog.Dialog):
 		"""
 		master.columnconfigure(1, weight=1)
 		master.rowconfigure(0, weight=1)
-		frm, self.file_list = ScrolledTreeview(master, columns=["path"],
-											   displaycolumns=[])
+		frm, self.file_list = ScrolledVirtualTreeview(master, columns=["path"],
+													 displaycolumns=[],
+													 _yscrolled=self.scrolled)
 		self.file_list.insert("", "end",
 							  text="@",
 							  iid="@",
@@ -249,16 +383,28 @@ class NewSubvolume(tkinter.simpledialog.Dialog):
 		return True
 
 	@ex_handler
-	def populate_dir(self, parentid, dirname):
+	def populate_dir(self, parentid, dirname, cursor=None):
 		"""Populate the tree node at parentid with the contents of the
-		directory dirname
+		directory dirname. Large directories are fetched LS_PAGE
+		entries at a time: the rest are fetched, by passing the
+		cursor the helper gives us back, when the user scrolls down
+		to them.
 		"""
-		ret, text, data = self.parent.request_array("ls", "-dir",
-													self.uuid,
-													dirname)
-		if dirname == ".":
-			dirname = ""
-		self.file_list.set_children(parentid)
+		options = ["-dir", "-limit={0}".format(LS_PAGE)]
+		if cursor is not None:
+			options.append("-cursor={0}".format(cursor))
+		ret, text, data = self.parent.request_array(
+			"ls", *(options + [self.uuid, dirname]))
+		# The page is followed by the cursor for the next one, if
+		# there is one
+		next_cursor = None
+		if data and "cursor" in data[-1]:
+			next_cursor = data.pop()["cursor"]
+		path = dirname
+		if path == ".":
+			path = ""
+		if cursor is None:
+			self.file_list.set_children(parentid)
 		for item in data:
 			extra = ""
 			img = self.parent.img["dir"]
@@ -266,16 +412,37 @@ class NewSubvolume(tkinter.simpledialog.Dialog):
 				img = self.parent.img["subv"]
 			iid = self.file_list.insert(parentid, "end",
 										text=item["name"]+extra,
-										values=[os.path.join(dirname,
+										values=[os.path.join(path,
 															 item["name"])],
 										open=False,
 										image=img)
 			self.file_list.insert(iid, "end", text="")
+		if next_cursor is not None:
+			iid = self.file_list.insert(parentid, "end", text="More...",
+										values=[path], tags=("more",))
+			self.more[iid] = (parentid, dirname, next_cursor)
+
+	def scrolled(self, first, last):
+		"""The file list has moved: fetch the next page of any
+		directory whose "More..." row has come into view
+		"""
+		for iid in list(self.more.keys()):
+			if iid not in self.more:
+				continue
+			if not self.file_list.exists(iid):
+				# Its directory has been re-read since
+				del self.more[iid]
+			elif self.file_list.bbox(iid) != "":
+				parentid, dirname, cursor = self.more.pop(iid)
+				self.file_list.delete(iid)
+				self.populate_dir(parentid, dirname, cursor)
 
 	def opened_dir(self, ev):
 		"""The user has opened up a tree node, and so we must populate
 		it with its contents, if any
 		"""
 		item = self.file_list.focus()
+		if item in self.more:
+			return
 		path = self.file_list.set(item, "path")
 		self.populate_dir(item, path)
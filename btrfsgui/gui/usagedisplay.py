@@ -4,7 +4,7 @@ from tkinter import *
 from tkinter.ttk import *
 import collections
 
-from btrfsgui.requester import Requester, ex_handler
+from btrfsgui.requester import Requester, ex_handler, report_error
 from btrfsgui.gui.lib import ScrolledCanvas
 import btrfsgui.btrfs as btrfs
 
@@ -20,12 +20,72 @@ COLOUR_UNUSED = "#ffffff"
 DF_BOX_PADDING = 20
 DF_BOX_WIDTH = 400
 DF_BOX_HEIGHT = 50
+# Height of the map of each device's chunk layout
+DEV_MAP_HEIGHT = 16
+# Distance between the stripes over allocated but unused space
+STRIPE_PERIOD = 8
 
 def fade(col):
 	rgb = [int(col[1:3], 16), int(col[3:5], 16), int(col[5:7], 16)]
 	rgb = [128+int(x/2) for x in rgb]
 	return "#{0:x}{1:x}{2:x}".format(*rgb)
 
+def stripe_tile(col, stripe):
+	"""PhotoImage data for one tile of the diagonal stripes drawn over
+	allocated but unused space. Tiled from the corner of a rectangle,
+	it gives a stripe every STRIPE_PERIOD pixels.
+	"""
+	rows = []
+	for y in range(STRIPE_PERIOD):
+		row = [stripe if (x + y) % STRIPE_PERIOD == STRIPE_PERIOD // 2
+			   else col
+			   for x in range(STRIPE_PERIOD)]
+		rows.append("{" + " ".join(row) + "}")
+	return " ".join(rows)
+
+def chunk_colour(flags):
+	"""The colour used for chunks with the given flags
+	"""
+	usage = btrfs.usage_type(flags)
+	colours = COLOURS[btrfs.replication_type(flags)]
+	if usage == "meta":
+		return colours[1]
+	if usage == "sys":
+		return colours[2]
+	return colours[0]
+
+def dev_map_data(bins, size, height):
+	"""Turn the bins of a dev_map reply into PhotoImage data, one
+	column of pixels per bin. From the bottom of each column, the
+	used part of the bin is drawn in the colour of its chunk type,
+	the rest of the allocated part in a faded version of it, and the
+	unallocated part in the unused colour.
+	"""
+	bin_size = float(size) / len(bins)
+	columns = []
+	for flags, alloc, used in bins:
+		if alloc == 0:
+			columns.append((0, 0, None, None))
+			continue
+		col = chunk_colour(flags)
+		columns.append((int(round(height * used / bin_size)),
+						int(round(height * alloc / bin_size)),
+						col, fade(col)))
+
+	rows = []
+	for y in range(height):
+		level = height - y
+		row = []
+		for used_px, alloc_px, col, faded in columns:
+			if used_px >= level:
+				row.append(col)
+			elif alloc_px >= level:
+				row.append(faded)
+			else:
+				row.append(COLOUR_UNUSED)
+		rows.append("{" + " ".join(row) + "}")
+	return " ".join(rows)
+
 class SplitBox(object):
 	"""Represents a rectangular area, split either horizontally or
 	vertically in given ratios, with coloured segments between each
@@ -149,6 +209,27 @@ class SplitBox(object):
 	def __iter__(self):
 		return SplitBox._Iter(self)
 
+class DeviceBox(LabelFrame):
+	"""The usage box and chunk map of a single device. These are kept
+	from one redraw to the next, so that a device whose usage hasn't
+	changed isn't drawn again.
+	"""
+	def __init__(self, master, path):
+		LabelFrame.__init__(self, master, text=path)
+		self.columnconfigure(0, weight=1)
+		self.canvas = Canvas(self,
+							 width=DF_BOX_WIDTH+2*DF_BOX_PADDING,
+							 height=DF_BOX_HEIGHT+2*DF_BOX_PADDING)
+		self.canvas.grid(sticky=N+S+E+W)
+		self.map = Label(self)
+		self.map.grid(sticky=W, padx=DF_BOX_PADDING,
+					  pady=(0, DF_BOX_PADDING))
+		self.map_image = None
+		# What the map was last fetched for, and what came back
+		self.map_key = None
+		self.map_bins = None
+		self.map_size = None
+
 class UsageDisplay(Frame, Requester):
 	"""Panel displaying usage statistics on a filesystem.
 	"""
@@ -157,6 +238,21 @@ class UsageDisplay(Frame, Requester):
 		Frame.__init__(self, parent)
 		Requester.__init__(self, comms)
 
+		self.fs = None
+		self.stale = False
+		# The last results drawn, as (fs, usage result, df result)
+		self.last_usage = None
+		# DeviceBoxes by devid, for the filesystem with boxes_uuid
+		self.dev_boxes = {}
+		self.boxes_uuid = None
+		# What each canvas was last drawn from, by canvas, and the
+		# stripe images drawn on it, which Tk forgets unless python
+		# holds on to them
+		self.render_keys = {}
+		self.stripe_images = {}
+		# How far each canvas is stretched from its natural size, as
+		# (x, y) factors
+		self.scales = {}
 		self.create_widgets()
 
 	def create_widgets(self):
@@ -196,19 +292,21 @@ class UsageDisplay(Frame, Requester):
 								 width=DF_BOX_WIDTH+2*DF_BOX_PADDING,
 								 height=DF_BOX_HEIGHT+2*DF_BOX_PADDING)
 		self.df_display.grid(sticky=N+S+E+W, columnspan=3)
+		self.df_display.bind(
+			"<Configure>", lambda e: self.scale_canvas(e.widget, e))
 
 		self.df_selection = StringVar()
 		Label(box, text="Show unallocated space").grid(row=1, column=0)
 		but = Radiobutton(
 			box, text="Allocated only",
 			variable=self.df_selection,
-			command=self.change_display,
+			command=self.redraw,
 			value="alloc")
 		but.grid(row=1, column=1, sticky=W)
 		but = Radiobutton(
 			box, text="As raw space",
 			variable=self.df_selection,
-			command=self.change_display,
+			command=self.redraw,
 			value="raw")
 		but.grid(row=2, column=1, sticky=W)
 		self.df_selection.set("alloc")
@@ -224,29 +322,48 @@ class UsageDisplay(Frame, Requester):
 		frm.grid(sticky=N+S+E+W, row=4, column=0,
 				 columnspan=len(COLOURS)+1,
 				 padx=8, pady=4)
-		self.per_disk.columnconfigure(0, weight=1)
+		# The devices' boxes are laid out in a frame in the canvas
+		self.per_disk_frame = Frame(self.per_disk)
+		self.per_disk_frame.columnconfigure(0, weight=1)
+		container = self.per_disk.create_window(
+			4, 4, anchor=N+W, window=self.per_disk_frame)
+		# ...and stretched to fill it
+		self.per_disk.bind(
+			"<Configure>",
+			lambda e: self.per_disk.itemconfigure(container,
+												  width=e.width-8))
+		self.per_disk_frame.bind(
+			"<Configure>",
+			lambda e: self.per_disk.configure(
+				scrollregion=(0, 0, e.width+8, e.height+8)))
 
 	def set_selected(self, fs):
 		"""Pass parameters for the basic FS information so that we
-		know how to get the relevant information from the helper.
+		know how to get the relevant information from the helper. It
+		isn't fetched until update_display() is called, when the tab
+		is shown.
 		"""
 		self.fs = fs
 		self.stale = True
-		self.update_display()
 
 	def create_usage_box(self, canvas, input_data, size=None,
-						 free=None, max_size=None):
+						 free=None, max_size=None, outline=False):
 		"""Analyse the individual chunks of input data, categorise the
 		space usage, and draw a usage box into the canvas. Data must
 		be an array of dictionaries, with keys 'flags', 'size' and
 		'used'. If a free space component is to be drawn, either
 		'size' or 'free' should be provided. If 'size' is set, the
 		amount of free space computed is returned; otherwise the
-		return value is arbitrary."""
+		return value is arbitrary. If the canvas already shows the
+		same data, it isn't drawn again."""
+
+		key = (tuple(sorted((bg["flags"], bg["size"], bg["used"])
+							for bg in input_data)),
+			   size, free, max_size, outline)
 
 		# Calculate the overall width of the box we are going to draw
 		width = DF_BOX_WIDTH
-		if max_size is not None:
+		if max_size:
 			width = width * size / max_size
 
 		# Categorise the data
@@ -282,6 +399,16 @@ class UsageDisplay(Frame, Requester):
 		elif free is not None:
 			freebox.append((free, { "fill": COLOUR_UNUSED }))
 
+		if self.render_keys.get(str(canvas)) == key:
+			return size
+		self.render_keys[str(canvas)] = key
+		canvas.delete("all")
+		if outline:
+			canvas.create_rectangle(
+				DF_BOX_PADDING-1, DF_BOX_PADDING-1,
+				DF_BOX_PADDING+DF_BOX_WIDTH, DF_BOX_PADDING+DF_BOX_HEIGHT,
+				width=1, fill="#00ff00", tags=("all", "outline"))
+
 		# total is our whole block
 		# *_total are the three main divisions
 		box = SplitBox(orient=SplitBox.HORIZONTAL)
@@ -300,87 +427,209 @@ class UsageDisplay(Frame, Requester):
 			ry1 = int(rect[1]+rect[3])
 			#print("Rectangle at", rect, rect[0]+rect[2], rx1, rect[1]+rect[3], ry1)
 
+			tags = ("all",)
+			if "stripe" in data:
+				tags = ("all", "striped")
 			canvas.create_rectangle(
 				rx0, ry0, rx1, ry1,
-				width=0, tags=("all"), fill=data["fill"])
-			if "stripe" in data:
-				for x in range(4, int(rect[2]+rect[3]), 8):
-					x0 = rx0 + x
-					y0 = ry0
-					x1 = rx0
-					y1 = ry0 + x
-
-					if x0 > rx1:
-						y0 += x0 - rx1
-						x0 = rx1
-					if y1 > ry1:
-						x1 += y1 - ry1
-						y1 = ry1
-
-					canvas.create_line(
-						x0, y0, x1, y1,	fill=data["stripe"],
-						tags=("all", "stripes"))
+				width=0, tags=tags, fill=data["fill"])
+
+		# The geometry is worked out at the natural size, and
+		# stretched to fit the canvas
+		sx, sy = self.scales.get(str(canvas), (1.0, 1.0))
+		if (sx, sy) != (1.0, 1.0):
+			canvas.scale("all", DF_BOX_PADDING, DF_BOX_PADDING, sx, sy)
+		self.draw_stripes(canvas)
 
 		return size
 
+	def draw_stripes(self, canvas):
+		"""Draw stripes over the canvas's striped rectangles, wherever
+		they are now. Each is one image, tiled with the stripes,
+		rather than a line for each stripe.
+		"""
+		canvas.delete("stripes")
+		images = self.stripe_images[str(canvas)] = []
+		for item in canvas.find_withtag("striped"):
+			x0, y0, x1, y1 = [int(round(c)) for c in canvas.coords(item)]
+			if x1 <= x0 or y1 <= y0:
+				continue
+			col = canvas.itemcget(item, "fill")
+			image = PhotoImage(width=x1-x0, height=y1-y0)
+			image.put(stripe_tile(col, fade(col)),
+					  to=(0, 0, x1-x0, y1-y0))
+			images.append(image)
+			canvas.create_image(x0, y0, anchor=N+W, image=image,
+								tags=("all", "stripes"))
+
+	def scale_canvas(self, canvas, ev):
+		"""The canvas has been resized: stretch what's drawn on it to
+		fit, without working it out again
+		"""
+		border = 2 * (int(canvas.cget("highlightthickness"))
+					  + int(canvas.cget("borderwidth")))
+		sx = max(0.1, float(ev.width - border - 2*DF_BOX_PADDING) / DF_BOX_WIDTH)
+		sy = max(0.1, float(ev.height - border - 2*DF_BOX_PADDING) / DF_BOX_HEIGHT)
+		old_sx, old_sy = self.scales.get(str(canvas), (1.0, 1.0))
+		if (sx, sy) == (old_sx, old_sy):
+			return
+		self.scales[str(canvas)] = (sx, sy)
+		canvas.scale("all", DF_BOX_PADDING, DF_BOX_PADDING,
+					 sx / old_sx, sy / old_sy)
+		self.draw_stripes(canvas)
+
 	def change_display(self):
 		self.stale = True
 		self.update_display()
 
 	@ex_handler
-	def update_display(self):
-		if not self.stale:
+	def update_display(self, token=None):
+		"""Fetch and draw the usage of the filesystem, if it's changed
+		since we last did. Requests made on behalf of a prefetch pass
+		its CancelToken.
+		"""
+		if not self.stale or self.fs is None:
+			return
+		self.stale = False
+
+		# Ask for everything at once, and draw it when it arrives
+		fs = self.fs
+		self.request_all_async(
+			lambda results: self.show_usage(fs, *results),
+			("fs_usage", fs["uuid"]),
+			("df", fs["uuid"]),
+			errback=lambda ex: self.fetch_failed(fs, ex),
+			token=token)
+
+	def redraw(self):
+		"""Draw the last results again, with the current display
+		options, without asking the helper
+		"""
+		if self.last_usage is not None and self.last_usage[0] is self.fs:
+			self.show_usage(*self.last_usage)
+		else:
+			self.change_display()
+
+	def show_dev_map(self, fs, box, obj):
+		"""Draw the reply to a dev_map request into a device's map
+		"""
+		if fs is not self.fs or not box.winfo_exists():
+			return
+		box.map_bins = obj["bins"]
+		box.map_size = obj["size"]
+		self.draw_map(box)
+
+	def draw_map(self, box):
+		"""Draw a device's map, stretched like its usage box. The bins
+		are resampled to the width on screen, rather than fetched
+		again.
+		"""
+		if box.map_bins is None:
+			return
+		bins = box.map_bins
+		sx, sy = self.scales.get(str(box.canvas), (1.0, 1.0))
+		width = max(1, int(len(bins) * sx))
+		if width != len(bins):
+			bins = [bins[i * len(bins) // width] for i in range(width)]
+		if box.map_image is None or box.map_image.width() != width:
+			box.map_image = PhotoImage(width=width, height=DEV_MAP_HEIGHT)
+			box.map.configure(image=box.map_image)
+		box.map_image.put(
+			dev_map_data(bins, box.map_size, DEV_MAP_HEIGHT), to=(0, 0))
+
+	def device_resized(self, box, ev):
+		"""A device's box has been resized: stretch its usage box and
+		map to fit
+		"""
+		self.scale_canvas(box.canvas, ev)
+		self.draw_map(box)
+
+	def fetch_failed(self, fs, ex):
+		"""Report a failed fetch, and try again next time
+		"""
+		if fs is self.fs:
+			self.stale = True
+		if not report_error(ex):
+			raise ex
+
+	def show_usage(self, fs, usage_result, df_result):
+		"""Draw the results of the fs_usage and df requests for fs
+		"""
+		if fs is not self.fs:
+			# The selection has changed since we asked
 			return
 
-		# Clean up the existing display
-		self.df_display.delete("all")
-		self.df_display.create_rectangle(
-			DF_BOX_PADDING-1, DF_BOX_PADDING-1,
-			DF_BOX_PADDING+DF_BOX_WIDTH, DF_BOX_PADDING+DF_BOX_HEIGHT,
-			width=1, fill="#00ff00", tags=("all", "outline"))
+		self.last_usage = (fs, usage_result, df_result)
 
-		self.per_disk.delete("all")
+		if self.boxes_uuid != fs["uuid"]:
+			# A different filesystem: start again
+			for box in self.dev_boxes.values():
+				self.render_keys.pop(str(box.canvas), None)
+				self.stripe_images.pop(str(box.canvas), None)
+				self.scales.pop(str(box.canvas), None)
+				box.destroy()
+			self.dev_boxes = {}
+			self.boxes_uuid = fs["uuid"]
 
-		# Now set up a block for each disk, and populate it
-		canvases = {}
 		raw_free = 0
 		max_space = 0
+		rv, text, usage = usage_result
+		devices = []
 		for dev in self.fs["vols"]:
-			rv, text, obj = self.request("vol_df", self.fs["uuid"], dev["id"])
+			# JSON object keys are always strings
+			obj = usage["devices"].get(str(dev["id"]))
+			if obj is None:
+				# Removed since the last scan
+				continue
 			dev["usage"] = obj
+			devices.append(dev)
 			if obj["size"] > max_space:
 				max_space = obj["size"]
 
-		y = 4
-		for i, dev in enumerate(self.fs["vols"]):
+		# Drop the boxes of devices which have gone away
+		present = set(dev["id"] for dev in devices)
+		for devid in list(self.dev_boxes.keys()):
+			if devid not in present:
+				box = self.dev_boxes.pop(devid)
+				self.render_keys.pop(str(box.canvas), None)
+				self.stripe_images.pop(str(box.canvas), None)
+				self.scales.pop(str(box.canvas), None)
+				box.destroy()
+
+		# Now make sure there's a box for each disk, and bring it up
+		# to date
+		for i, dev in enumerate(devices):
 			obj = dev["usage"]
-			frame = LabelFrame(self.per_disk,
-							   text=dev["path"])
-			frame.grid(sticky=N+S+E+W)
-			container = self.per_disk.create_window(
-				4, y, anchor=N+W,
-				tags=("all", "dev{0}".format(i), dev["path"]),
-				window=frame)
-			frame.columnconfigure(0, weight=1)
-			canvas = Canvas(frame,
-							width=DF_BOX_WIDTH+2*DF_BOX_PADDING,
-							height=DF_BOX_HEIGHT+2*DF_BOX_PADDING)
-			canvas.grid(sticky=N+S+E+W)
-			canvases[dev["id"]] = canvas
-			self.update_idletasks()
-			bbox = self.per_disk.bbox(container)
-			y = bbox[3] + 4
-			raw_free += self.create_usage_box(canvas,
+			box = self.dev_boxes.get(dev["id"])
+			if box is None:
+				box = DeviceBox(self.per_disk_frame, dev["path"])
+				box.canvas.bind("<Configure>",
+								lambda e, box=box: self.device_resized(box, e))
+				self.dev_boxes[dev["id"]] = box
+			else:
+				box.configure(text=dev["path"])
+			box.grid(row=i, column=0, sticky=N+S+E+W, pady=2)
+			raw_free += self.create_usage_box(box.canvas,
 											  obj["usage"].values(),
 											  size=obj["size"],
 											  max_size=max_space)
-		self.per_disk.configure(
-			scrollregion=(0, 0,
-						  DF_BOX_WIDTH+DF_BOX_PADDING*2+20, y))
+
+			# Where the chunks are on the device: fetched again only
+			# when the device's usage has changed
+			map_width = 1
+			if max_space > 0:
+				map_width = max(1, int(DF_BOX_WIDTH * obj["size"] / max_space))
+			map_key = (map_width, self.render_keys[str(box.canvas)])
+			if box.map_key != map_key:
+				box.map_key = map_key
+				self.request_async(
+					lambda rv, text, dmap, box=box:
+						self.show_dev_map(fs, box, dmap),
+					"dev_map", fs["uuid"], dev["id"], map_width)
 
 		# Get the allocation and usage of all the block group types
-		rv, text, obj = self.request("df", self.fs["uuid"])
+		rv, text, obj = df_result
 		kwargs = {}
 		if self.df_selection.get() == "raw":
 			kwargs["free"] = raw_free
-		self.create_usage_box(self.df_display, obj, **kwargs)
+		self.create_usage_box(self.df_display, obj, outline=True, **kwargs)
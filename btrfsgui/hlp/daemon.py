@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""Run the helper as a long-lived daemon, serving any number of
+requesters over a Unix socket. The filesystems mounted by the helper,
+and its caches, are then shared between requesters, and kept between
+one GUI session and the next.
+
+The socket is either created by us, or passed to us by systemd socket
+activation (as fd 3, with LISTEN_FDS and LISTEN_PID set). Only root,
+and the users and groups allowed on the command line, may connect:
+we check the credentials of the process on the other end of each
+connection.
+"""
+
+import os
+import sys
+import stat
+import socket
+import struct
+import threading
+import traceback
+import pwd
+import grp
+
+from btrfsgui.hlp.lib import HelperException
+
+# Not all versions of python know about this, but Linux does
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+ucred = struct.Struct("3i")
+
+# The first fd passed by systemd
+LISTEN_FDS_START = 3
+
+def run_daemon(options, pool, serve):
+	"""Accept connections for ever, and serve(rfile, wfile, pool) each
+	one on its own thread.
+	"""
+	users = set(_resolve(pwd.getpwnam, "pw_uid", u)
+				for u in options.allow_users)
+	groups = set(_resolve(grp.getgrnam, "gr_gid", g)
+				 for g in options.allow_groups)
+
+	listener = _activated_socket()
+	if listener is None:
+		listener = _listen(options.daemon)
+	sys.stderr.write("Helper: daemon listening on {0}\n".format(
+		listener.getsockname()))
+
+	while True:
+		conn, addr = listener.accept()
+		thread = threading.Thread(target=_connection,
+								  args=(conn, users, groups, pool, serve))
+		thread.daemon = True
+		thread.start()
+
+def _resolve(lookup, field, name):
+	"""Turn a user or group name (or number) into its ID
+	"""
+	if name.isdigit():
+		return int(name)
+	try:
+		return getattr(lookup(name), field)
+	except KeyError:
+		raise HelperException("Unknown user or group {0}".format(name))
+
+def _activated_socket():
+	"""Return the listening socket passed to us by systemd, if there
+	is one
+	"""
+	if os.environ.get("LISTEN_PID") != str(os.getpid()):
+		return None
+	if int(os.environ.get("LISTEN_FDS", "0")) < 1:
+		return None
+	# Don't pass the socket on to anything we run
+	del os.environ["LISTEN_PID"]
+	del os.environ["LISTEN_FDS"]
+	return socket.fromfd(LISTEN_FDS_START, socket.AF_UNIX, socket.SOCK_STREAM)
+
+def _listen(path):
+	"""Create the listening socket at <path>, replacing any stale one
+	"""
+	try:
+		if stat.S_ISSOCK(os.lstat(path).st_mode):
+			os.unlink(path)
+	except OSError:
+		pass
+	listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	listener.bind(path)
+	# Anyone may connect: who is allowed to stay is checked by
+	# _allowed()
+	os.chmod(path, 0666)
+	listener.listen(16)
+	return listener
+
+def _allowed(conn, users, groups):
+	"""Check whether the process at the other end of a connection may
+	use us.
+	"""
+	creds = conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, ucred.size)
+	pid, uid, gid = ucred.unpack(creds)
+	if uid == 0 or uid in users or gid in groups:
+		return True
+	# Check the user's other groups, too
+	try:
+		name = pwd.getpwuid(uid).pw_name
+	except KeyError:
+		return False
+	for gid in groups:
+		try:
+			if name in grp.getgrgid(gid).gr_mem:
+				return True
+		except KeyError:
+			pass
+	sys.stderr.write("Helper: refused connection from pid {0}, uid {1}\n".format(pid, uid))
+	return False
+
+def _connection(conn, users, groups, pool, serve):
+	"""Serve a single connection
+	"""
+	rfile = conn.makefile("r")
+	wfile = conn.makefile("w")
+	try:
+		if not _allowed(conn, users, groups):
+			wfile.write("ERR 403 Not allowed\n")
+			wfile.flush()
+			return
+		serve(rfile, wfile, pool)
+	except SystemExit:
+		# A requester asking us to quit only ends its own connection
+		pass
+	except Exception:
+		traceback.print_exc(None, sys.stderr)
+	finally:
+		try:
+			wfile.close()
+		except Exception:
+			pass
+		rfile.close()
+		conn.close()
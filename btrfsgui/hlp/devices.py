@@ -8,20 +8,19 @@ import sys
 import fcntl
 import multiprocessing
 
-from btrfsgui.hlp.mount import Filesystem, cleanup
+from btrfsgui.hlp.mount import Filesystem
 import btrfsgui.btrfs as btrfs
 from btrfsgui.hlp.lib import HelperException
 
 def _rm_dev_async(uuid, devname):
 	"""This operation could be insanely long-lived, so we run this in
-	a separate process. The use of Filesystem here will (probably)
-	generate a second temporary file
+	a separate process. The process shares the parent's pooled mount
+	of the filesystem, which the parent keeps for as long as we run.
 	"""
 	with Filesystem(uuid) as fsfd:
 		buf = btrfs.sized_array()
 		btrfs.ioctl_vol_args.pack_into(buf, 0, 0, devname)
 		fcntl.ioctl(fsfd, btrfs.IOC_DEV_RM, buf)
-	cleanup()
 
 def rm_dev(params):
 	"""Remove a device from the FS. This takes a very long time, so
@@ -29,10 +28,12 @@ def rm_dev(params):
 	"""
 	uuid = params[0]
 	devname = params[1]
-	proc = multiprocessing.Process(
-		target=_rm_dev_async,
-		args=(uuid, devname),)
-	proc.start()
+	with Filesystem(uuid) as fs:
+		proc = multiprocessing.Process(
+			target=_rm_dev_async,
+			args=(uuid, devname),)
+		proc.start()
+		fs.attach(proc)
 
 def add_dev(params):
 	"""Add a device to the FS.
@@ -9,8 +9,14 @@ import sys
 import os.path
 import os
 import stat
+import fcntl
+import errno
+import re
+from multiprocessing.pool import ThreadPool
 
-from btrfsgui.hlp.lib import HelperException
+import btrfsgui.btrfs as btrfs
+import btrfsgui.protocol as protocol
+from btrfsgui.hlp.lib import HelperException, emit
 
 SEARCH_PATH = (os.environ["PATH"].split(os.pathsep)
 			   + [ "/usr/local/sbin",
@@ -23,7 +29,228 @@ SEARCH_PATH = (os.environ["PATH"].split(os.pathsep)
 _found_btrfs = None
 _found_mkfs = None
 
+SYSFS_BTRFS = "/sys/fs/btrfs"
+# How many devices to read superblocks from at once
+PROBE_THREADS = 16
+_MOUNT_ESCAPE = re.compile(r"\\([0-7]{3})")
+
 def scan(parameters):
+	"""Find all the btrfs filesystems on the machine, and their
+	devices. Mounted filesystems are found through sysfs and the
+	filesystem ioctls, and unmounted ones by reading the superblocks
+	of block devices directly. If the kernel doesn't provide the
+	sysfs information, fall back to asking the btrfs tool.
+	"""
+	if os.path.isdir(SYSFS_BTRFS):
+		fslist = _scan_native()
+	else:
+		fslist = _scan_btrfs_show()
+
+	emit(fslist)
+
+def _scan_native():
+	"""Enumerate btrfs filesystems without running any external tools
+	"""
+	fslist = []
+	claimed = set()
+	mountpoints = _btrfs_mountpoints()
+	for uuid in os.listdir(SYSFS_BTRFS):
+		fsdir = os.path.join(SYSFS_BTRFS, uuid)
+		devdir = os.path.join(fsdir, "devices")
+		if not os.path.isdir(devdir):
+			continue # Not a filesystem (e.g. "features")
+
+		volumes = _mounted_volumes(mountpoints.get(uuid))
+		if volumes is None:
+			# We can't see where it's mounted, so leave the devices
+			# for the superblock probe to find
+			continue
+		claimed.update(os.listdir(devdir))
+
+		# An empty label file means the filesystem is unlabelled:
+		# only older kernels, without the file, need the superblock
+		label = None
+		label_path = os.path.join(fsdir, "label")
+		if os.path.exists(label_path):
+			label = _read_sysfs(label_path)
+		elif volumes:
+			sb = _probe_superblock(volumes[0]["path"])
+			if sb is not None:
+				label = sb[1]
+		sys.stderr.write("Helper: found label {0}, UUID {1}\n".format(label, uuid))
+		fslist.append({"label": label, "uuid": uuid, "vols": volumes})
+
+	paths = [os.path.join("/dev", devname.replace("!", "/"))
+			 for devname in _block_devices()
+			 if devname not in claimed]
+	for uuid, fs in probe_devices(paths):
+		sys.stderr.write("Helper: found label {0}, UUID {1}\n".format(fs["label"], uuid))
+		fslist.append(fs)
+		for vol in fs["vols"]:
+			_register_device(vol["path"])
+
+	return fslist
+
+def probe_devices(paths):
+	"""Read the superblocks of all the given devices, PROBE_THREADS at
+	a time, and return a list of (UUID, filesystem) for the btrfs
+	filesystems found on them. Each filesystem is a dict in the same
+	form that scan() returns.
+	"""
+	pool = ThreadPool(min(PROBE_THREADS, max(len(paths), 1)))
+	try:
+		results = pool.map(_probe_superblock, paths)
+	finally:
+		pool.close()
+		pool.join()
+
+	found = {}
+	res = []
+	for path, sb in zip(paths, results):
+		if sb is None:
+			continue
+		uuid, label, devid = sb
+		if uuid not in found:
+			found[uuid] = {"label": label, "uuid": uuid, "vols": []}
+			res.append((uuid, found[uuid]))
+		found[uuid]["vols"].append({"id": devid, "path": path})
+
+	for uuid, fs in res:
+		fs["vols"].sort(key=lambda vol: vol["id"])
+	return res
+
+def _btrfs_mountpoints():
+	"""Return a dictionary of UUID -> a mountpoint of the filesystem,
+	for all the mounted btrfs filesystems we can see.
+	"""
+	res = {}
+	with open("/proc/self/mounts") as mounts:
+		for line in mounts:
+			fields = line.split()
+			if len(fields) < 3 or fields[2] != "btrfs":
+				continue
+			# Spaces and the like are octal-escaped in mount paths
+			path = _MOUNT_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)),
+									 fields[1])
+			try:
+				fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+			except OSError:
+				continue
+			try:
+				buf = btrfs.sized_array(btrfs.ioctl_fs_info_args.size)
+				fcntl.ioctl(fd, btrfs.IOC_FS_INFO, buf)
+				max_id, num_devices, fsid = btrfs.ioctl_fs_info_args.unpack(buf)
+			except IOError:
+				continue
+			finally:
+				os.close(fd)
+			res.setdefault(btrfs.format_uuid(fsid), path)
+	return res
+
+def _mounted_volumes(mountpoint):
+	"""Return the list of devices of the filesystem mounted at
+	mountpoint, or None if there isn't one.
+	"""
+	if mountpoint is None:
+		return None
+	fd = os.open(mountpoint, os.O_RDONLY | os.O_DIRECTORY)
+	try:
+		buf = btrfs.sized_array(btrfs.ioctl_fs_info_args.size)
+		fcntl.ioctl(fd, btrfs.IOC_FS_INFO, buf)
+		max_id, num_devices, fsid = btrfs.ioctl_fs_info_args.unpack(buf)
+
+		volumes = []
+		buf = btrfs.sized_array(btrfs.ioctl_dev_info_args.size)
+		for devid in xrange(1, max_id+1):
+			btrfs.ioctl_dev_info_args.pack_into(buf, 0, devid, b"", 0, 0, b"")
+			try:
+				fcntl.ioctl(fd, btrfs.IOC_DEV_INFO, buf)
+			except IOError, ex:
+				if ex.errno == errno.ENODEV:
+					continue # Gaps in the devids are normal
+				raise
+			data = btrfs.ioctl_dev_info_args.unpack(buf)
+			path = protocol.native_str(data[4].rstrip(b"\0"))
+			sys.stderr.write("Helper: found dev {0} = {1}\n".format(devid, path))
+			volumes.append({"id": devid, "path": path})
+		return volumes
+	finally:
+		os.close(fd)
+
+def _read_sysfs(path):
+	"""Return the contents of a sysfs attribute, or None if it's
+	missing or empty.
+	"""
+	try:
+		with open(path) as f:
+			value = f.read().rstrip("\n")
+	except IOError:
+		return None
+	if value == "":
+		return None
+	return value
+
+def _block_devices():
+	"""Return the kernel names of all the block devices and partitions
+	on the machine
+	"""
+	devices = []
+	with open("/proc/partitions") as parts:
+		for line in parts:
+			fields = line.split()
+			# Skip the header line and the blank one after it
+			if len(fields) != 4 or not fields[0].isdigit():
+				continue
+			devices.append(fields[3])
+	return devices
+
+def _probe_superblock(path):
+	"""Read the superblock of a device. Returns (UUID, label, devid)
+	if it has a btrfs filesystem on it, or None otherwise.
+	"""
+	try:
+		with open(path, "rb") as dev:
+			dev.seek(btrfs.SUPER_INFO_OFFSET)
+			sb = dev.read(btrfs.SUPER_INFO_SIZE)
+	except (IOError, OSError):
+		return None
+	if len(sb) < btrfs.SUPER_INFO_SIZE:
+		return None
+
+	fields = btrfs.super_block.unpack_from(sb)
+	if fields[4] != btrfs.SUPER_MAGIC:
+		return None
+	devid = btrfs.dev_item.unpack_from(sb, btrfs.SUPER_DEV_ITEM_OFFSET)[0]
+	label = btrfs.super_label.unpack_from(sb, btrfs.SUPER_LABEL_OFFSET)[0]
+	label = protocol.native_str(label.split(b"\0", 1)[0])
+	if label == "":
+		label = None
+	return (btrfs.format_uuid(fields[1]), label, devid)
+
+def _register_device(path):
+	"""Tell the kernel about a btrfs device, so that multi-device
+	filesystems can be mounted. This is what btrfs dev scan does.
+	"""
+	try:
+		fd = os.open("/dev/btrfs-control", os.O_RDWR)
+	except OSError:
+		return
+	try:
+		buf = btrfs.sized_array()
+		name = path
+		if not isinstance(name, bytes):
+			name = name.encode("utf-8")
+		btrfs.ioctl_vol_args.pack_into(buf, 0, 0, name)
+		fcntl.ioctl(fd, btrfs.IOC_SCAN_DEV, buf)
+	except IOError, ex:
+		sys.stderr.write("Helper: couldn't register {0}: {1}\n".format(path, ex))
+	finally:
+		os.close(fd)
+
+def _scan_btrfs_show():
+	"""Enumerate btrfs filesystems by running btrfs dev scan and
+	parsing the output of btrfs fi show.
+	"""
 	global _found_btrfs
 
 	devnull = open(os.devnull, "w")
@@ -59,8 +286,7 @@ def scan(parameters):
 			volumes.append({"id": int(spl[1]), "path": spl[7]})
 			continue
 
-	sys.stdout.write(json.dumps(fslist))
-	sys.stdout.write("\n")
+	return fslist
 
 
 def mkfs(parameters):
@@ -3,49 +3,230 @@
 import sys
 import traceback
 import os
+import threading
+import collections
+import importlib
+from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
 
-import btrfsgui.hlp.globalops
-import btrfsgui.hlp.vfs
-import btrfsgui.hlp.size
-import btrfsgui.hlp.subvol
-import btrfsgui.hlp.devices
-from btrfsgui.hlp.lib import HelperException
+import btrfsgui.hlp.mount
+import btrfsgui.btrfs as btrfs
+import btrfsgui.protocol as protocol
+from btrfsgui.hlp.lib import HelperException, Reply, FrameReply, set_reply
+
+# Protocol features, listed in the ready message:
+#   tags: requests may be tagged with an ID, echoed on every reply line
+#   frames=<codec>,...: the binary framed protocol can be switched to
+#     with "proto frames <codec>"
+#   zlib: the streams in both directions can be compressed, with
+#     "proto zlib"
+FEATURES = ["tags", "frames=" + ",".join(protocol.codec_names()), "zlib"]
+
+# How many tagged requests may run at once
+WORKERS = 8
+
+# Commands are serialised against each other according to their entry
+# in COMMANDS:
+#   None: no locking, run concurrently with anything
+#   "fs": one at a time on each filesystem (the UUID is the first
+#         parameter)
+#   "global": one at a time across the whole helper
+_global_lock = threading.Lock()
+_fs_locks = collections.defaultdict(threading.Lock)
+_fs_locks_lock = threading.Lock()
+
+# Command handlers which have been imported, by name
+_handlers = {}
 
 def quit_all(params):
 	sys.exit(0)
 
 def main():
 	"""Run a R-E-P loop."""
+	parser = OptionParser()
+	parser.add_option("-b", "--search-buffer", action="store", type="int",
+					  dest="search_buffer", metavar="<bytes>",
+					  default=btrfs.search_buf_size,
+					  help="Size of the buffer used for tree searches")
+	parser.add_option("-w", "--workers", action="store", type="int",
+					  dest="workers", metavar="<n>", default=WORKERS,
+					  help="Number of requests to run concurrently")
+	parser.add_option("-d", "--daemon", action="store", dest="daemon",
+					  metavar="<socket>",
+					  help="Run as a daemon, serving requesters on the Unix socket <socket>")
+	parser.add_option("-u", "--allow-user", action="append",
+					  dest="allow_users", metavar="<user>", default=[],
+					  help="Allow <user> to connect to the daemon (as well as root)")
+	parser.add_option("-g", "--allow-group", action="append",
+					  dest="allow_groups", metavar="<group>", default=[],
+					  help="Allow members of <group> to connect to the daemon")
+	parser.add_option("-t", "--idle-timeout", action="store", type="int",
+					  dest="idle_timeout", metavar="<seconds>",
+					  default=btrfsgui.hlp.mount.IDLE_TIMEOUT,
+					  help="Unmount filesystems unused for this long")
+	(options, args) = parser.parse_args()
+	btrfs.set_search_buffer_size(options.search_buffer)
+	btrfsgui.hlp.mount.IDLE_TIMEOUT = options.idle_timeout
 
 	if os.geteuid() != 0:
 		sys.stdout.write("ERR 550 Root helper not running as root\n")
 		sys.stdout.flush()
 		sys.exit(1)
-	else:
-		sys.stdout.write("OK 200 Ready\n")
-		sys.stdout.flush()
 
+	pool = ThreadPool(max(options.workers, 1))
+	try:
+		if options.daemon is not None:
+			# Only needed in daemon mode, so not imported up front
+			from btrfsgui.hlp.daemon import run_daemon
+			run_daemon(options, pool, serve)
+		else:
+			serve(sys.stdin, sys.stdout, pool)
+	finally:
+		pool.close()
+		pool.join()
+
+def serve(rfile, wfile, pool):
+	"""Talk to one requester over the streams rfile and wfile, running
+	its requests on the worker pool, until it goes away.
+	"""
+	# Advertise the protocol features we support after the message
+	wfile.write("OK 200 Ready {0}\n".format(" ".join(FEATURES)))
+	wfile.flush()
+
+	# Replies to concurrent requests share the output stream
+	output_lock = threading.Lock()
+	jobs = []
+	try:
+		while True:
+			line = protocol.native_str(rfile.readline())
+			line = line[:-1] # Chop off the trailing \n
+			if line == "":
+				break
+			# A request may be tagged with "@<tag> " at the start of
+			# the line, in which case every line of the reply is
+			# tagged the same way, and the request is run by the
+			# worker pool. Untagged requests are run in order, as the
+			# requester can't match up out-of-order replies to them.
+			tag = None
+			if line.startswith("@"):
+				tag, tmp, line = line[1:].partition(" ")
+			parameters = parse(line)
+			reply = Reply(wfile, output_lock, tag)
+			if parameters[:2] == ["proto", "zlib"]:
+				# Everything after our acknowledgement is compressed,
+				# in both directions
+				reply.ok(200, "zlib")
+				reply.flush()
+				rfile = protocol.CompressedReader(rfile)
+				wfile = protocol.CompressedWriter(
+					getattr(wfile, "buffer", wfile))
+			elif parameters[:2] == ["proto", "frames"]:
+				codec = negotiate_frames(reply, parameters[2:])
+				if codec is not None:
+					serve_frames(pool, codec,
+								 getattr(rfile, "buffer", rfile),
+								 getattr(wfile, "buffer", wfile),
+								 output_lock, jobs)
+					break
+			elif tag is None or parameters[:1] == ["quit"]:
+				run(reply, parameters)
+			else:
+				jobs.append(pool.apply_async(run, (reply, parameters)))
+				jobs[:] = [job for job in jobs if not job.ready()]
+	finally:
+		# Let the outstanding requests finish before we go
+		for job in jobs:
+			job.wait()
+
+def negotiate_frames(reply, parameters):
+	"""Handle a request to switch to the framed protocol, and return
+	the codec to use, or None if we can't.
+	"""
+	if len(parameters) != 1 or parameters[0] not in protocol.CODECS:
+		reply.err(400, "Unsupported protocol")
+		reply.flush()
+		return None
+	# This is the last thing we say in plain text
+	reply.ok(200, "frames {0}".format(parameters[0]))
+	reply.flush()
+	return protocol.get_codec(parameters[0])
+
+def serve_frames(pool, codec, rfile, wfile, output_lock, jobs):
+	"""Read requests in the framed protocol from rfile, and run them,
+	until the stream ends. Replies are written to wfile holding
+	output_lock. Requests passed to the worker pool are added to jobs.
+	"""
 	while True:
-		sys.stdin.flush()
-		line = sys.stdin.readline()
-		line = line[:-1] # Chop off the trailing \n
-		if line == "":
+		frame = protocol.read_frame(rfile)
+		if frame is None:
 			break
-		parameters = parse(line)
-		command = parameters.pop(0)
-
-		if command not in COMMANDS:
-			sys.stdout.write("ERR Command not known\n")
-		try:
-			COMMANDS[command](parameters)
-			sys.stdout.write("OK 200 All good\n")
-		except HelperException, ex:
-			sys.stdout.write("ERR {0.rv} {0.message}\n".format(ex))
-			traceback.print_exc(None, sys.stderr)
-		except Exception, ex:
-			sys.stdout.write("ERR 550 Root helper exception: {0}\n".format(ex))
-			traceback.print_exc(None, sys.stderr)
-		sys.stdout.flush()
+		kind, tag, payload = frame
+		reply = FrameReply(wfile, output_lock, tag, codec)
+		if kind != protocol.REQUEST:
+			reply.err(400, "Not a request")
+			reply.flush()
+			continue
+		parameters = [protocol.native_str(p) for p in codec.decode(payload)]
+		if parameters[:1] == ["quit"]:
+			run(reply, parameters)
+		else:
+			jobs.append(pool.apply_async(run, (reply, parameters)))
+			jobs[:] = [job for job in jobs if not job.ready()]
+
+def run(reply, parameters):
+	"""Run a single command, sending its output and result to reply
+	"""
+	set_reply(reply)
+	if len(parameters) == 0 or parameters[0] not in COMMANDS:
+		reply.err(404, "Command not known")
+		reply.flush()
+		return
+
+	command = parameters.pop(0)
+	fn, serialise = COMMANDS[command]
+	try:
+		with _command_lock(serialise, parameters):
+			_handler(fn)(parameters)
+		reply.ok(200, "All good")
+	except HelperException, ex:
+		reply.err(ex.rv, ex.message)
+		traceback.print_exc(None, sys.stderr)
+	except Exception, ex:
+		reply.err(550, "Root helper exception: {0}".format(ex))
+		traceback.print_exc(None, sys.stderr)
+	reply.flush()
+
+def _handler(fn):
+	"""Return the function for a COMMANDS entry, importing its module
+	the first time it's needed. Entries are either functions, or
+	"module:function" strings, so that we don't pay for importing
+	every command's module before we can say we're ready.
+	"""
+	if callable(fn):
+		return fn
+	if fn not in _handlers:
+		module, tmp, name = fn.partition(":")
+		_handlers[fn] = getattr(importlib.import_module(module), name)
+	return _handlers[fn]
+
+def _command_lock(serialise, parameters):
+	"""Return the lock a command must hold while it runs
+	"""
+	if serialise == "global":
+		return _global_lock
+	if serialise == "fs" and len(parameters) > 0:
+		with _fs_locks_lock:
+			return _fs_locks[parameters[0]]
+	return _no_lock
+
+class _NoLock(object):
+	def __enter__(self):
+		pass
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		return False
+
+_no_lock = _NoLock()
 
 def parse(line):
 	"""Parse a line of input into tokens. Tokens are separated by
@@ -71,18 +252,22 @@ def parse(line):
 	return output
 
 COMMANDS = {
-	"quit": quit_all,
-	"scan": btrfsgui.hlp.globalops.scan,
-	"mkfs": btrfsgui.hlp.globalops.mkfs,
-	"df": btrfsgui.hlp.size.df,
-	"vol_df": btrfsgui.hlp.size.volume_df,
-	"sub_list": btrfsgui.hlp.subvol.sv_list,
-	"sub_del": btrfsgui.hlp.subvol.sv_del,
-	"sub_make": btrfsgui.hlp.subvol.sv_make,
-	"sub_snap": btrfsgui.hlp.subvol.sv_snap,
-	"sub_def": btrfsgui.hlp.subvol.sv_def,
-	"ls": btrfsgui.hlp.vfs.ls,
-	"ls_blk": btrfsgui.hlp.vfs.ls_blk,
-	"rm_dev": btrfsgui.hlp.devices.rm_dev,
-	"add_dev": btrfsgui.hlp.devices.add_dev,
+	"quit": (quit_all, None),
+	"scan": ("btrfsgui.hlp.globalops:scan", "global"),
+	"mkfs": ("btrfsgui.hlp.globalops:mkfs", "global"),
+	"df": ("btrfsgui.hlp.size:df", None),
+	"vol_df": ("btrfsgui.hlp.size:volume_df", "fs"),
+	"fs_usage": ("btrfsgui.hlp.size:fs_usage", "fs"),
+	"dev_map": ("btrfsgui.hlp.size:dev_map", "fs"),
+	"qgroups": ("btrfsgui.hlp.size:qgroups", None),
+	"sub_list": ("btrfsgui.hlp.subvol:sv_list", None),
+	"sub_list_since": ("btrfsgui.hlp.subvol:sv_list_since", None),
+	"sub_del": ("btrfsgui.hlp.subvol:sv_del", "fs"),
+	"sub_make": ("btrfsgui.hlp.subvol:sv_make", "fs"),
+	"sub_snap": ("btrfsgui.hlp.subvol:sv_snap", "fs"),
+	"sub_def": ("btrfsgui.hlp.subvol:sv_def", "fs"),
+	"ls": ("btrfsgui.hlp.vfs:ls", None),
+	"ls_blk": ("btrfsgui.hlp.vfs:ls_blk", None),
+	"rm_dev": ("btrfsgui.hlp.devices:rm_dev", "fs"),
+	"add_dev": ("btrfsgui.hlp.devices:add_dev", "fs"),
 	}
@@ -6,8 +6,114 @@
 import os
 import os.path
 import stat
+import json
+import collections
+import threading
+
+import btrfsgui.protocol as protocol
 
 class HelperException(Exception):
 	def __init__(self, msg, value=500):
 		self.message = msg
 		self.rv = value
+
+class Reply(object):
+	"""The output stream for the reply to a single request. If the
+	request was tagged, every line of the reply carries the same tag,
+	so that the requester can match it up with the request. Lines are
+	collected, and written out together by flush(), holding lock, so
+	that replies to concurrent requests on the same stream are never
+	interleaved. Each stream has its own lock, so a requester which
+	stops reading holds up only its own replies.
+	"""
+	def __init__(self, out, lock, tag=None):
+		self.out = out
+		self.lock = lock
+		self.tag = tag
+		self.lines = []
+
+	def line(self, text):
+		if self.tag is not None:
+			text = "@{0} {1}".format(self.tag, text)
+		self.lines.append(text + "\n")
+
+	def data(self, obj):
+		self.line(json.dumps(obj))
+
+	def ok(self, rv, message):
+		self.line("OK {0} {1}".format(rv, message))
+
+	def err(self, rv, message):
+		self.line("ERR {0} {1}".format(rv, message))
+
+	def flush(self):
+		with self.lock:
+			self.out.write("".join(self.lines))
+			self.out.flush()
+		self.lines = []
+
+class FrameReply(Reply):
+	"""The reply to a single request, in the binary framed protocol
+	"""
+	def __init__(self, out, lock, tag, codec):
+		Reply.__init__(self, out, lock, tag)
+		self.codec = codec
+
+	def data(self, obj):
+		self.lines.append(protocol.pack_frame(
+			protocol.DATA, self.tag, self.codec.encode(obj)))
+
+	def ok(self, rv, message):
+		self.lines.append(protocol.pack_frame(
+			protocol.OK, self.tag, self.codec.encode([rv, message])))
+
+	def err(self, rv, message):
+		self.lines.append(protocol.pack_frame(
+			protocol.ERR, self.tag, self.codec.encode([rv, message])))
+
+	def flush(self):
+		with self.lock:
+			self.out.write(b"".join(self.lines))
+			self.out.flush()
+		self.lines = []
+
+# The reply to the request being run by each thread
+_current = threading.local()
+
+def set_reply(reply):
+	"""Send the output of emit() in this thread to <reply> from now on
+	"""
+	_current.reply = reply
+
+def emit(obj):
+	"""Write an object as part of the reply to the current request
+	"""
+	_current.reply.data(obj)
+
+class LRUCache(object):
+	"""A mapping holding at most <size> entries, which drops the least
+	recently used entry when it fills up.
+	"""
+	def __init__(self, size):
+		self.size = size
+		self.data = collections.OrderedDict()
+
+	def __contains__(self, key):
+		return key in self.data
+
+	def __len__(self):
+		return len(self.data)
+
+	def get(self, key, default=None):
+		try:
+			value = self.data.pop(key)
+		except KeyError:
+			return default
+		self.data[key] = value
+		return value
+
+	def __setitem__(self, key, value):
+		self.data.pop(key, None)
+		self.data[key] = value
+		if len(self.data) > self.size:
+			self.data.popitem(last=False)
@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
 
 """Operations dealing with mounting and unmounting btrfs filesystems
+
+Filesystems are mounted on first use, and kept mounted (along with an
+open file descriptor for their top level) in a pool shared by all
+commands, and by any worker processes forked from the helper. A
+filesystem is unmounted once nothing has used it for IDLE_TIMEOUT
+seconds.
 """
 
 import os
@@ -9,8 +15,43 @@ import sys
 import subprocess
 import tempfile
 import atexit
+import threading
+import time
+import multiprocessing.util
+
+# How long an unused filesystem stays mounted, in seconds
+IDLE_TIMEOUT = 60
 
 _local_dir = None
+# The process which made the mounts, and is responsible for removing
+# them again
+_owner = None
+# Mounts by UUID
+_mounts = {}
+_lock = threading.RLock()
+# UUIDs of the filesystems being unmounted, and a condition notified
+# whenever one of them is done. umount can be slow, so it runs without
+# the lock, and only requests for those filesystems wait for it.
+_unmounting = set()
+_unmounted = threading.Condition(_lock)
+_reaper = None
+
+class _Mount(object):
+	"""A filesystem mounted by us, with a cached fd for its top level
+	"""
+	def __init__(self, uuid):
+		self.uuid = uuid
+		self.path = os.path.join(_local_dir, uuid)
+		self.fd = None
+		self.refs = 0
+		self.last_used = time.time()
+		self.workers = []
+
+	def busy(self):
+		"""Check whether anything is still using this filesystem
+		"""
+		self.workers = [w for w in self.workers if w.is_alive()]
+		return self.refs > 0 or len(self.workers) > 0
 
 class Filesystem(object):
 	"""Context manager for opening a filesystem.
@@ -18,7 +59,7 @@ class Filesystem(object):
 	class _DirFD(object):
 		def __init__(self, manager):
 			self.manager = manager
-			self.fd = manager.fd
+			self.fd = manager.mount.fd
 
 		def __str__(self):
 			return str(self.fd)
@@ -30,8 +71,7 @@ class Filesystem(object):
 			"""Return and maintain a file descriptor for a path within
 			this filesystem.
 			"""
-			fd = os.open(os.path.join(_local_dir, str(os.getpid()),
-									  self.manager.uuid, dir),
+			fd = os.open(os.path.join(self.manager.mount.path, dir),
 						 os.O_DIRECTORY)
 			self.manager.fds.append(fd)
 			return fd
@@ -40,41 +80,140 @@ class Filesystem(object):
 			"""Return a full local filesystem path to the given object
 			in this filesystem
 			"""
-			return os.path.join(_local_dir, str(os.getpid()),
-								self.manager.uuid, path)
+			return os.path.join(self.manager.mount.path, path)
+
+		def attach(self, worker):
+			"""Keep the filesystem mounted for as long as the given
+			multiprocessing.Process is running, even after this
+			context has been left.
+			"""
+			with _lock:
+				self.manager.mount.workers.append(worker)
 
 	def __init__(self, uuid):
 		self.uuid = uuid
 		self.fds = []
 
 	def __enter__(self):
-		global _local_dir
-		mount(self.uuid)
-		path = os.path.join(_local_dir, str(os.getpid()), self.uuid)
-		self.fd = os.open(path, os.O_DIRECTORY)
+		self.mount = acquire(self.uuid)
 		return self._DirFD(self)
 
 	def __exit__(self, exc_type, exc_value, traceback):
-		os.close(self.fd)
 		for fd in self.fds:
 			os.close(fd)
+		self.fds = []
+		release(self.mount)
 		# Return false to re-throw any exception in progress as we exit
 		return False
 
+def acquire(uuid):
+	"""Return the pooled mount of the filesystem with UUID=uuid,
+	mounting it if necessary, and take a reference to it.
+	"""
+	global _reaper
+	with _lock:
+		while uuid in _unmounting:
+			_unmounted.wait()
+		mnt = _mounts.get(uuid)
+		if mnt is None:
+			mount(uuid)
+			mnt = _mounts[uuid] = _Mount(uuid)
+		if mnt.fd is None:
+			mnt.fd = os.open(mnt.path, os.O_DIRECTORY)
+		mnt.refs += 1
+
+		if _reaper is None:
+			_reaper = threading.Thread(target=_reap_idle)
+			_reaper.daemon = True
+			_reaper.start()
+		return mnt
+
+def release(mnt):
+	"""Drop a reference taken by acquire()
+	"""
+	with _lock:
+		mnt.refs -= 1
+		mnt.last_used = time.time()
+
+def expire(timeout=None):
+	"""Unmount all filesystems which have not been used for <timeout>
+	seconds (by default, IDLE_TIMEOUT).
+	"""
+	if timeout is None:
+		timeout = IDLE_TIMEOUT
+	now = time.time()
+	with _lock:
+		if os.getpid() != _owner:
+			return
+		idle = [mnt for mnt in _mounts.values()
+				if mnt.uuid not in _unmounting and not mnt.busy()
+				and now - mnt.last_used >= timeout]
+		for mnt in idle:
+			_close(mnt)
+			_unmounting.add(mnt.uuid)
+
+	for mnt in idle:
+		done = False
+		try:
+			done = umount(mnt.uuid, fatal=False)
+		finally:
+			with _lock:
+				# If it's still mounted, keep it, and try again next
+				# time round
+				if done:
+					del _mounts[mnt.uuid]
+				_unmounting.discard(mnt.uuid)
+				_unmounted.notify_all()
+
+def _reap_idle():
+	"""Background thread: unmount idle filesystems
+	"""
+	while True:
+		time.sleep(max(IDLE_TIMEOUT / 4.0, 1))
+		try:
+			expire()
+		except Exception as ex:
+			sys.stderr.write("Helper: failed to unmount idle filesystem: {0}\n".format(ex))
+
+def _close(mnt):
+	"""Close the cached fd of a pooled mount
+	"""
+	if mnt.fd is not None:
+		os.close(mnt.fd)
+		mnt.fd = None
+
+def _unmount(mnt, fatal=True):
+	"""Close the cached fd of a pooled mount, and unmount it
+	"""
+	_close(mnt)
+	if umount(mnt.uuid, fatal):
+		del _mounts[mnt.uuid]
+
+def _after_fork(lock):
+	"""A forked worker can't know the state of the lock in its parent
+	at the time of the fork, so give it a fresh one. Nor will it see
+	the end of any unmount in progress there.
+	"""
+	global _lock, _unmounted
+	_lock = threading.RLock()
+	_unmounted = threading.Condition(_lock)
+	_unmounting.clear()
+
+multiprocessing.util.register_after_fork(_lock, _after_fork)
+
 @atexit.register
 def cleanup():
-	"""Global clean-up: unmount _all_ of our temporary files.
+	"""Global clean-up: unmount _all_ of our temporary files. Forked
+	workers leave this to the process which made the mounts.
 	"""
 	global _local_dir
-	if _local_dir is None:
+	if _local_dir is None or os.getpid() != _owner:
 		return
 
-	mysubdir = os.path.join(_local_dir, str(os.getpid()))
-
-	for d in os.listdir(mysubdir):
-		umount(d, fatal=False)
+	with _lock:
+		for mnt in list(_mounts.values()):
+			_unmount(mnt, fatal=False)
 	try:
-		os.rmdir(mysubdir)
 		os.rmdir(_local_dir)
 	except:
 		pass
@@ -87,12 +226,13 @@ def mount(uuid):
 
 	If the filesystem is already mounted, do nothing.
 	"""
-	global _local_dir
+	global _local_dir, _owner
 	if _local_dir is None:
 		_local_dir = tempfile.mkdtemp(prefix="btrfs-gui-")
+		_owner = os.getpid()
 		sys.stderr.write("Helper: Created private directory {0}\n".format(_local_dir))
 
-	dirpath = os.path.join(_local_dir, str(os.getpid()), uuid)
+	dirpath = os.path.join(_local_dir, uuid)
 	try:
 		os.makedirs(dirpath)
 	except OSError, ex:
@@ -103,26 +243,34 @@ def mount(uuid):
 	cmd = ["mount", "-t", "btrfs",
 		   "-o", "subvolid=0",
 		   "UUID={0}".format(uuid), dirpath]
-	subprocess.check_call(cmd)
+	try:
+		subprocess.check_call(cmd)
+	except:
+		os.rmdir(dirpath)
+		raise
 	sys.stderr.write("Helper: Mounted filesystem UUID={0} at {1}\n".format(uuid, dirpath))
 
 def umount(uuid, fatal=True):
 	"""Unmount the filesystem with UUID=<uuid>, and clean up after
 	ourselves. If <fatal> is True, then raise exceptions at the
 	earliest opportunity. Otherwise, try each step of the process in
-	turn, regardless of whether it succeeded or failed.
+	turn, regardless of whether it succeeded or failed. Returns True
+	if the filesystem was unmounted.
 	"""
-	dirpath = os.path.join(_local_dir, str(os.getpid()), uuid)
+	dirpath = os.path.join(_local_dir, uuid)
 	cmd = ["umount", dirpath]
 
 	if fatal:
 		subprocess.check_call(cmd)
 		os.rmdir(dirpath)
 	else:
-		subprocess.call(cmd)
+		if subprocess.call(cmd) != 0:
+			sys.stderr.write("Helper: Failed to umount filesystem UUID={0} from {1}\n".format(uuid, dirpath))
+			return False
 		try:
 			os.rmdir(dirpath)
 		except OSError:
 			pass
 
 	sys.stderr.write("Helper: Umounted filesystem UUID={0} from {1}\n".format(uuid, dirpath))
+	return True
@@ -3,13 +3,12 @@
 """Functions dealing with determining the sizes of things
 """
 
-import sys
 import fcntl
-import json
+import errno
 
 from btrfsgui.hlp.mount import Filesystem
 import btrfsgui.btrfs as btrfs
-from btrfsgui.hlp.lib import HelperException
+from btrfsgui.hlp.lib import HelperException, emit
 
 def df(params):
 	"""Collect information on the usage of the filesystem. Replicate
@@ -39,8 +38,7 @@ def df(params):
 		flags, total, used = btrfs.ioctl_space_info.unpack_from(ret, offset)
 		res.append({"flags": flags, "size": total, "used": used})
 
-	sys.stdout.write(json.dumps(res))
-	sys.stdout.write("\n")
+	emit(res)
 
 def volume_df(params):
 	"""Collect usage statistics on a specific volume in the filesystem.
@@ -49,95 +47,417 @@ def volume_df(params):
 	devid = int(devid)
 
 	with Filesystem(uuid) as fsfd:
-		# First, collect per-device data for this device
-		buf = btrfs.sized_array()
-		items = btrfs.search(fsfd,
-							 btrfs.CHUNK_TREE_OBJECTID,
-							 btrfs.DEV_ITEMS_OBJECTID, btrfs.DEV_ITEM_KEY, devid,
-							 number=1,
-							 buf=buf,
-							 structure=btrfs.dev_item)
-
-		if len(items) > 1:
-			raise HelperException("More than one record for this devid!")
-		if len(items) < 1:
-			raise HelperException("devid not found")
-
-		res = {}
-		header, raw_data, data = items[0]
-
-		res["size"] = data[1]
-		res["used"] = data[2]
-		res["uuid"] = btrfs.format_uuid(data[12])
+		index = _get_index(uuid, fsfd)
+
+	if devid not in index.devices:
+		raise HelperException("devid not found")
+	res = index.usage(devid)
+
+	emit(res)
+
+def fs_usage(params):
+	"""Collect usage statistics on every device in the filesystem, and
+	on every replication profile, in one go.
+	"""
+	uuid = params[0]
+
+	with Filesystem(uuid) as fsfd:
+		index = _get_index(uuid, fsfd)
+
+	profiles = {}
+	for chunk_offset, (chunk_length, chunk_type) in index.chunks.items():
+		if chunk_type not in profiles:
+			profiles[chunk_type] = {
+				"flags": chunk_type,
+				"size": 0,
+				"used": 0,
+				}
+		profiles[chunk_type]["size"] += chunk_length
+		profiles[chunk_type]["used"] += index.bg_used[chunk_offset]
+
+	res = {
+		# Keys are strings, however the reply is encoded
+		"devices": dict((str(devid), index.usage(devid))
+						for devid in index.devices),
+		"profiles": list(profiles.values()),
+		}
+	emit(res)
+
+def dev_map(params):
+	"""Collect a map of where the chunks sit on a single device,
+	downsampled to <width> bins so that the reply is the same size
+	however many chunks there are.
+
+	dev_map <uuid> <devid> <width>
+	"""
+	uuid, devid, width = params
+	devid = int(devid)
+	width = int(width)
+	if width < 1 or width > MAX_MAP_WIDTH:
+		raise HelperException("Map width out of range", 400)
+
+	with Filesystem(uuid) as fsfd:
+		index = _get_index(uuid, fsfd)
+
+	if devid not in index.devices:
+		raise HelperException("devid not found")
+	res = index.layout(devid, width)
+
+	emit(res)
+
+def qgroups(params):
+	"""Report the referenced and exclusive sizes of every subvolume,
+	and any limits on them, from the quota tree. This is what btrfs
+	qgroup show reports, read in a single pass over the tree.
+
+	qgroups <uuid>
+
+	Returns whether quotas are enabled, whether the kernel thinks the
+	numbers are out of date, and a dictionary of subvolume ID -> sizes
+	of its level 0 qgroup.
+	"""
+	uuid = params[0]
+	res = {"enabled": False, "inconsistent": False, "qgroups": {}}
+	with Filesystem(uuid) as fsfd:
+		try:
+			items = list(_read_qgroups(fsfd))
+		except IOError, ex:
+			# There's no quota tree if quotas have never been enabled
+			if ex.errno != errno.ENOENT:
+				raise
+			items = []
+
+	groups = res["qgroups"]
+	for key_type, qgroupid, data in items:
+		if key_type == btrfs.QGROUP_STATUS_KEY:
+			version, generation, flags, rescan = data
+			res["enabled"] = bool(flags & btrfs.QGROUP_STATUS_FLAG_ON)
+			res["inconsistent"] = bool(flags & btrfs.QGROUP_STATUS_FLAG_INCONSISTENT)
+			continue
+		if qgroupid >> btrfs.QGROUP_LEVEL_SHIFT != 0:
+			continue
+		# Keys are strings, however the reply is encoded
+		group = groups.setdefault(str(qgroupid), {
+			"referenced": None, "exclusive": None,
+			"max_referenced": None, "max_exclusive": None,
+			})
+		if key_type == btrfs.QGROUP_INFO_KEY:
+			generation, rfer, rfer_cmpr, excl, excl_cmpr = data
+			group["referenced"] = rfer
+			group["exclusive"] = excl
+		elif key_type == btrfs.QGROUP_LIMIT_KEY:
+			flags, max_rfer, max_excl, rsv_rfer, rsv_excl = data
+			if flags & btrfs.QGROUP_LIMIT_MAX_RFER:
+				group["max_referenced"] = max_rfer
+			if flags & btrfs.QGROUP_LIMIT_MAX_EXCL:
+				group["max_exclusive"] = max_excl
+
+	emit(res)
+
+def _read_qgroups(fsfd):
+	"""Yield (key type, qgroup ID, unpacked item) for the status item,
+	and every qgroup info and limit item, in the quota tree
+	"""
+	structures = {
+		btrfs.QGROUP_STATUS_KEY: btrfs.qgroup_status_item,
+		btrfs.QGROUP_INFO_KEY: btrfs.qgroup_info_item,
+		btrfs.QGROUP_LIMIT_KEY: btrfs.qgroup_limit_item,
+		}
+	# These all have objectid 0: relations, which we don't want, have
+	# the ID of a qgroup
+	for header, raw_data, data in btrfs.search_iter(
+			fsfd,
+			btrfs.QUOTA_TREE_OBJECTID,
+			0,
+			(btrfs.QGROUP_STATUS_KEY, btrfs.QGROUP_LIMIT_KEY),
+			view=True):
+		structure = structures.get(header[3])
+		if structure is not None:
+			yield (header[3], header[2], structure.unpack_from(raw_data))
+
+# Largest number of bins a device map may be split into
+MAX_MAP_WIDTH = 16384
+
+# Per-filesystem usage indexes, by UUID
+_indexes = {}
+# When refreshing block group usage from the extent tree, give up and
+# look each block group up by key if we get more than this many items
+# back per chunk: most of the extent tree has changed.
+INCREMENTAL_ITEMS_PER_CHUNK = 256
+
+def _get_index(uuid, fsfd):
+	"""Return the usage index for the filesystem, brought up to date
+	"""
+	index = _indexes.get(uuid)
+	if index is None:
+		index = _indexes[uuid] = UsageIndex()
+	index.refresh(fsfd)
+	return index
+
+class UsageIndex(object):
+	"""In-memory index of the devices, chunks, device extents and
+	block group usage of a filesystem.
+
+	Each refresh only re-reads the parts of the trees which have been
+	written since the generation seen by the previous one. Searches
+	include that generation itself, since a tree block can be changed
+	again within the transaction which first changed it.
+	"""
+	def __init__(self):
+		self.devices = {}
+		self.chunks = {}
+		self.extents = {}
+		self.bg_used = {}
+		self.bg_tree = False
+		self.chunk_gen = None
+		self.bg_gen = None
+
+	def refresh(self, fsfd):
+		"""Bring the index up to date with the filesystem. A full
+		re-read happens only when the chunk tree has changed: chunks
+		are allocated, removed or moved far less often than the usage
+		of their block groups changes.
+		"""
+		if self.chunk_gen is None or self._chunks_changed(fsfd):
+			# Read everything before changing anything, so that a
+			# failure part of the way through leaves the index as it
+			# was, and the next refresh reads it all again
+			devices, chunks, chunk_gen = _read_chunk_tree(fsfd)
+			extents = _read_dev_extents(fsfd)
+			bg_tree = _has_block_group_tree(fsfd)
+			bg_used, bg_gen = _read_block_groups(fsfd, chunks, bg_tree)
+			self.devices, self.chunks, self.chunk_gen = devices, chunks, chunk_gen
+			self.extents = extents
+			self.bg_tree = bg_tree
+			self.bg_used, self.bg_gen = bg_used, bg_gen
+		else:
+			self._update_block_groups(fsfd)
+
+	def _chunks_changed(self, fsfd):
+		"""Check whether anything in the chunk tree differs from what
+		we read last time
+		"""
+		devices, chunks, gen = _read_chunk_tree(fsfd, self.chunk_gen)
+		if gen > self.chunk_gen:
+			return True
+		for devid, dev in devices.items():
+			if self.devices.get(devid) != dev:
+				return True
+		for chunk_offset, chunk_info in chunks.items():
+			if self.chunks.get(chunk_offset) != chunk_info:
+				return True
+		return False
+
+	def _update_block_groups(self, fsfd):
+		"""Re-read the usage of the block groups stored in tree blocks
+		written since the last refresh
+		"""
+		if self.bg_tree:
+			used, gen = _read_block_groups(fsfd, self.chunks, True,
+										   self.bg_gen)
+		else:
+			try:
+				used, gen = _read_extent_tree_block_groups(
+					fsfd, self.chunks, self.bg_gen,
+					INCREMENTAL_ITEMS_PER_CHUNK * len(self.chunks))
+			except _TooManyChanges:
+				used, gen = _read_block_groups(fsfd, self.chunks, False)
+		for chunk_offset, bg_used in used.items():
+			if chunk_offset in self.bg_used:
+				self.bg_used[chunk_offset] = bg_used
+		self.bg_gen = max(self.bg_gen, gen)
+
+	def usage(self, devid):
+		"""Return the size and per-profile usage of a single device
+		"""
+		res = dict(self.devices[devid])
 		res["usage"] = {}
+		for chunk_offset, ext_length, phys in self.extents.get(devid, []):
+			if chunk_offset not in self.chunks:
+				raise HelperException("Device extent found for unknown chunk at {0}".format(chunk_offset))
+			chunk_length, chunk_type = self.chunks[chunk_offset]
+			if chunk_type not in res["usage"]:
+				res["usage"][chunk_type] = {
+					"flags": chunk_type,
+					"size": 0,
+					"used": 0,
+					}
+			res["usage"][chunk_type]["size"] += ext_length
+			# We have a total of chunk_used space used, out of
+			# chunk_length in this block group. So
+			# chunk_used/chunk_length is the proportion of the BG
+			# used. We multiply that by the length of the dev_extent
+			# to get the amount of space used in the dev_extent.
+			chunk_used = self.bg_used[chunk_offset]
+			res["usage"][chunk_type]["used"] += chunk_used * ext_length / chunk_length
+		return res
+
+	def layout(self, devid, width):
+		"""Split a single device into <width> equal bins, and return
+		the size of the device and a list of [flags, allocated, used]
+		for each bin. flags are those of the chunk type occupying most
+		of the bin, or 0 if none of it is allocated; allocated and
+		used are in bytes. A device with no size has an empty map.
+		"""
+		size = self.devices[devid]["size"]
+		if size <= 0:
+			return {"size": 0, "bins": [[0, 0, 0] for b in xrange(width)]}
+		alloc = [0] * width
+		used = [0] * width
+		types = [None] * width
+		for chunk_offset, ext_length, phys in self.extents.get(devid, []):
+			if chunk_offset not in self.chunks:
+				raise HelperException("Device extent found for unknown chunk at {0}".format(chunk_offset))
+			chunk_length, chunk_type = self.chunks[chunk_offset]
+			fill = float(self.bg_used[chunk_offset]) / chunk_length
+
+			# Spread the extent over the bins it covers
+			start = phys
+			end = min(phys + ext_length, size)
+			b = start * width // size
+			while start < end and b < width:
+				piece = min(end, (b + 1) * size // width) - start
+				if piece > 0:
+					alloc[b] += piece
+					used[b] += int(piece * fill)
+					if types[b] is None:
+						types[b] = {}
+					types[b][chunk_type] = types[b].get(chunk_type, 0) + piece
+					start += piece
+				b += 1
 
-		# Now, collect data on the block group types in use
-		last_offset = 0
-		while True:
-			# Iterate over all chunk extents on this device
-			items = btrfs.search(fsfd,
-								 btrfs.DEV_TREE_OBJECTID,
-								 devid,
-								 btrfs.DEV_EXTENT_KEY,
-								 (last_offset, btrfs.MINUS_ONE),
-								 buf=buf,
-								 structure=btrfs.dev_extent)
-			if not items:
-				break
-
-			while items:
-				header, raw_data, ext_data = items.pop(0)
-
-				ext_offset = header[2]
-				last_offset = ext_offset+1
-			
-				chunk_objid = ext_data[1]
-				chunk_offset = ext_data[2]
-				ext_length = ext_data[3]
-
-				# For each extent on this device, we need to look up what
-				# it's a part of
-				chunks = btrfs.search(fsfd,
-									  btrfs.CHUNK_TREE_OBJECTID,
-									  chunk_objid, btrfs.CHUNK_ITEM_KEY, chunk_offset,
-									  buf=buf,
-									  structure=btrfs.chunk,
-									  number=1)
-				if len(chunks) != 1:
-					raise HelperException("Wrong number of results from searching for a single chunk key ({0})".format(len(chunks)))
-				header, raw_data, chunk_info = chunks[0]
-
-				chunk_length = chunk_info[0]
-				chunk_type = chunk_info[3]
-
-				# Get the amount of space used in this block group, as well
-				extents = btrfs.search(fsfd,
-									   btrfs.EXTENT_TREE_OBJECTID,
-									   chunk_offset, btrfs.BLOCK_GROUP_ITEM_KEY,
-									   buf=buf,
-									   structure=btrfs.block_group_item,
-									   number=1)
-				if len(extents) != 1:
-					raise HelperException("Wrong number of results from searching for a single extent key ({0})".format(len(extents)))
-				header, raw_data, extent_info = extents[0]
-
-				if header[2] != chunk_length:
-					raise HelperException("Chunk length inconsistent: chunk tree says {0} bytes, extent tree says {1} bytes".format(chunk_length, header[2]))
-				chunk_used = extent_info[0]
-													  
-				if chunk_type not in res["usage"]:
-					res["usage"][chunk_type] = {
-						"flags": chunk_type,
-						"size": 0,
-						"used": 0,
-						}
-				res["usage"][chunk_type]["size"] += ext_length
-				# We have a total of chunk_used space used, out of
-				# chunk_length in this block group. So
-				# chunk_used/chunk_length is the proportion of the BG
-				# used. We multiply that by the length of the dev_extent
-				# to get the amount of space used in the dev_extent.
-				res["usage"][chunk_type]["used"] += chunk_used * ext_length / chunk_length
-
-	sys.stdout.write(json.dumps(res))
-	sys.stdout.write("\n")
+		bins = []
+		for b in xrange(width):
+			if types[b] is None:
+				bins.append([0, 0, 0])
+			else:
+				bins.append([max(types[b], key=types[b].get),
+							 alloc[b], used[b]])
+		return {"size": size, "bins": bins}
+
+class _TooManyChanges(Exception):
+	pass
+
+def _read_chunk_tree(fsfd, min_gen=0):
+	"""Read the device items and chunk items from the chunk tree, in a
+	single pass, restricted to tree blocks of generation min_gen or
+	later. Returns a dictionary of devid -> device data, one of chunk
+	offset -> (length, type), and the highest generation seen.
+	"""
+	devices = {}
+	chunks = {}
+	gen = min_gen
+	for header, raw_data, data in btrfs.search_iter(
+			fsfd,
+			btrfs.CHUNK_TREE_OBJECTID,
+			(btrfs.DEV_ITEMS_OBJECTID, btrfs.FIRST_CHUNK_TREE_OBJECTID),
+			(btrfs.DEV_ITEM_KEY, btrfs.CHUNK_ITEM_KEY),
+			transid=(min_gen, btrfs.MINUS_ONE),
+			view=True):
+		gen = max(gen, header[0])
+		if header[3] == btrfs.DEV_ITEM_KEY:
+			dev = btrfs.dev_item.unpack_from(raw_data)
+			devices[dev[0]] = {
+				"size": dev[1],
+				"used": dev[2],
+				"uuid": btrfs.format_uuid(dev[12]),
+				}
+		elif header[3] == btrfs.CHUNK_ITEM_KEY:
+			chunk_info = btrfs.chunk.unpack_from(raw_data)
+			chunks[header[2]] = (chunk_info[0], chunk_info[3])
+	return devices, chunks, gen
+
+def _read_dev_extents(fsfd):
+	"""Return a dictionary of devid -> list of (chunk offset, length,
+	physical offset) for every device extent in the filesystem, from a
+	single pass over the dev tree.
+	"""
+	extents = {}
+	for header, raw_data, ext_data in btrfs.search_iter(
+			fsfd,
+			btrfs.DEV_TREE_OBJECTID,
+			(1, btrfs.MINUS_ONE),
+			btrfs.DEV_EXTENT_KEY,
+			structure=btrfs.dev_extent,
+			view=True):
+		if header[3] != btrfs.DEV_EXTENT_KEY:
+			continue
+		extents.setdefault(header[1], []).append(
+			(ext_data[2], ext_data[3], header[2]))
+	return extents
+
+def _has_block_group_tree(fsfd):
+	"""Check whether the filesystem keeps its block group items in a
+	separate tree
+	"""
+	items = btrfs.search(fsfd,
+						 btrfs.ROOT_TREE_OBJECTID,
+						 btrfs.BLOCK_GROUP_TREE_OBJECTID,
+						 btrfs.ROOT_ITEM_KEY,
+						 number=1)
+	return len(items) > 0
+
+def _read_block_groups(fsfd, chunks, bg_tree, min_gen=0):
+	"""Return a dictionary of chunk offset -> bytes used, for each of
+	the given chunks, and the highest generation seen.
+
+	If the filesystem has a block group tree, this is a single pass
+	over it, restricted to tree blocks of generation min_gen or
+	later. Otherwise, the block group items are scattered through the
+	extent tree, and it's far cheaper to look each one up by key than
+	to walk the whole extent tree.
+	"""
+	used = {}
+	gen = min_gen
+	if bg_tree:
+		for header, raw_data, bg_data in btrfs.search_iter(
+				fsfd,
+				btrfs.BLOCK_GROUP_TREE_OBJECTID,
+				(0, btrfs.MINUS_ONE),
+				btrfs.BLOCK_GROUP_ITEM_KEY,
+				transid=(min_gen, btrfs.MINUS_ONE),
+				structure=btrfs.block_group_item,
+				view=True):
+			gen = max(gen, header[0])
+			if header[3] == btrfs.BLOCK_GROUP_ITEM_KEY:
+				used[header[1]] = bg_data[0]
+		return used, gen
+
+	for chunk_offset in chunks:
+		extents = btrfs.search(fsfd,
+							   btrfs.EXTENT_TREE_OBJECTID,
+							   chunk_offset, btrfs.BLOCK_GROUP_ITEM_KEY,
+							   structure=btrfs.block_group_item,
+							   number=1)
+		if len(extents) != 1:
+			raise HelperException("Wrong number of results from searching for a single extent key ({0})".format(len(extents)))
+		header, raw_data, extent_info = extents[0]
+		used[chunk_offset] = extent_info[0]
+		gen = max(gen, header[0])
+	return used, gen
+
+def _read_extent_tree_block_groups(fsfd, chunks, min_gen, limit):
+	"""Return the block group usage found in extent tree blocks of
+	generation min_gen or later, and the highest generation seen. On
+	an idle filesystem, this is only a handful of tree blocks. Raise
+	_TooManyChanges after limit items, when it would be cheaper to
+	look up every block group directly.
+	"""
+	used = {}
+	gen = min_gen
+	if not chunks:
+		return used, gen
+	for count, (header, raw_data, bg_data) in enumerate(btrfs.search_iter(
+			fsfd,
+			btrfs.EXTENT_TREE_OBJECTID,
+			(min(chunks), max(chunks)),
+			btrfs.BLOCK_GROUP_ITEM_KEY,
+			transid=(min_gen, btrfs.MINUS_ONE),
+			structure=btrfs.block_group_item,
+			view=True)):
+		if count >= limit:
+			raise _TooManyChanges()
+		gen = max(gen, header[0])
+		if header[3] == btrfs.BLOCK_GROUP_ITEM_KEY:
+			used[header[1]] = bg_data[0]
+	return used, gen
@@ -7,124 +7,237 @@ import sys
 import fcntl
 import array
 import struct
-import json
 import itertools
 import os.path
 import stat
 
 from btrfsgui.hlp.mount import Filesystem
 import btrfsgui.btrfs as btrfs
-from btrfsgui.hlp.lib import HelperException
+from btrfsgui.hlp.lib import HelperException, emit, LRUCache
 
-def local_path(fs, tree, inode):
+# Number of directory paths remembered by local_path() within a
+# single request
+PATH_CACHE_SIZE = 4096
+
+def local_path(fs, tree, inode, cache=None):
 	"""Return the full path (as a list of names) of the object with
 	the given inode number in the given FS tree.
+
+	If a cache (an LRUCache) is given, the paths of the object and all
+	its ancestors are remembered in it, keyed by (tree, inode), and
+	any ancestor already in it is not looked up again.
 	"""
-	rv = []
-	buf = btrfs.sized_array()
+	path = []
+	visited = []
 	while inode != 256:
-		items = btrfs.search(fs,
-							 tree,
-							 inode, btrfs.INODE_REF_KEY,
-							 buf=buf,
-							 structure=btrfs.inode_ref)
-		if not items:
+		if cache is not None:
+			known = cache.get((tree, inode))
+			if known is not None:
+				path = known
+				break
+
+		for header, raw_data, data in btrfs.search_iter(
+				fs,
+				tree,
+				inode, btrfs.INODE_REF_KEY,
+				structure=btrfs.inode_ref,
+				view=True):
+			index, name_len = data
+			name = btrfs.name_struct(name_len).unpack_from(
+				raw_data, btrfs.inode_ref.size)[0]
+			break
+		else:
 			raise HelperException(
 				"Item {0} in tree {1} has no INODE_REF".format(inode, tree))
 
-		header, raw_data, data = items[0]
-		index, name_len = data
+		visited.append((inode, name))
 		inode = header[2] # offset of the key is the objid of the parent
-		name = struct.unpack_from("{0}s".format(name_len),
-								  raw_data,
-								  btrfs.inode_ref.size)[0]
-		rv.append(name)
 
-	rv.reverse()
-	return rv
+	visited.reverse()
+	for inode, name in visited:
+		path = path + [name]
+		if cache is not None:
+			cache[(tree, inode)] = path
+	return list(path)
 
 def is_subvol(st):
 	"""Check whether the object with stat results "st" is a subvolume
 	"""
 	return (stat.S_ISDIR(st.st_mode) and st.st_ino == 256)
 
+def _default_subvol(fsfd):
+	"""Return the ID of the default subvolume, or None if there isn't
+	a default set.
+	"""
+	for header, raw_data, data in btrfs.search_iter(
+			fsfd,
+			btrfs.ROOT_TREE_OBJECTID,
+			btrfs.ROOT_TREE_DIR_OBJECTID,
+			btrfs.DIR_ITEM_KEY,
+			structure=btrfs.dir_item,
+			view=True):
+		name = btrfs.name_struct(data[5]).unpack_from(
+			raw_data, btrfs.dir_item.size)[0]
+		if name == "default":
+			return data[0]
+	return None
+
+def _trees_with_moved_dirs(fsfd, since, trees):
+	"""Return those of the given trees in which a directory has been
+	created, renamed or moved in generation <since> or later. Only
+	the tree blocks written since then are read.
+	"""
+	changed = set()
+	gen = since
+	for header, raw_data, data in btrfs.search_iter(
+			fsfd,
+			btrfs.ROOT_TREE_OBJECTID,
+			(btrfs.FS_TREE_OBJECTID, btrfs.MINUS_ONE),
+			btrfs.ROOT_ITEM_KEY,
+			transid=(since, btrfs.MINUS_ONE),
+			structure=btrfs.root_item,
+			view=True):
+		if header[3] != btrfs.ROOT_ITEM_KEY or data is None:
+			continue
+		gen = max(gen, data[0])
+		if header[1] in trees and data[0] >= since:
+			changed.add(header[1])
+
+	moved = set()
+	for tree in changed:
+		# A directory entry carries the transaction which made it, so
+		# entries merely sharing a tree block with other changes are
+		# skipped
+		for header, raw_data, data in btrfs.search_iter(
+				fsfd,
+				tree,
+				(btrfs.FIRST_FREE_OBJECTID, btrfs.MINUS_ONE),
+				btrfs.DIR_INDEX_KEY,
+				transid=(since, btrfs.MINUS_ONE),
+				structure=btrfs.dir_item,
+				view=True):
+			if (header[3] == btrfs.DIR_INDEX_KEY and data is not None
+				and data[1] == btrfs.INODE_ITEM_KEY
+				and data[6] == btrfs.FT_DIR
+				and data[3] >= since):
+				moved.add(tree)
+				break
+	return moved, gen
+
+def _list_subvols(fsfd, since=0):
+	"""Find the subvolumes on the filesystem. Returns a dictionary of
+	the subvolumes whose ROOT_BACKREF is in a tree block of generation
+	<since> or later, or which are in a subvolume where a directory
+	has been created or moved since then (as it may be on the path to
+	them), plus all the subvolumes below them (since their paths
+	depend on their parents); a list of the IDs of all subvolumes;
+	the highest generation seen; and the ID of the default subvolume.
+	"""
+	backrefs = {}
+	children = {}
+	gen = since
+	# Find all trees in the tree of tree roots. This is one small item
+	# for each subvolume, and we need all of them to spot deleted
+	# subvolumes and to build full paths.
+	for header, raw_data, data in btrfs.search_iter(
+			fsfd,
+			btrfs.ROOT_TREE_OBJECTID,
+			(btrfs.FIRST_FREE_OBJECTID, btrfs.MINUS_ONE),
+			btrfs.ROOT_BACKREF_KEY,
+			structure=btrfs.root_ref,
+			view=True):
+		if header[3] != btrfs.ROOT_BACKREF_KEY:
+			continue
+		gen = max(gen, header[0])
+		sv_id = header[1]
+		sv_parent_subvol = header[2]
+
+		dirid, sequence, name_len = data
+		name = btrfs.name_struct(name_len).unpack_from(
+			raw_data, btrfs.root_ref.size)[0]
+		backrefs[sv_id] = (name, sv_parent_subvol, dirid, header[0])
+		children.setdefault(sv_parent_subvol, []).append(sv_id)
+
+	# Work out which subvolumes we need to report
+	todo = [sv_id for sv_id, ref in backrefs.items() if ref[3] >= since]
+	# Everything is reported the first time, so there's no need to
+	# look for moved directories then
+	moved, tree_gen = _trees_with_moved_dirs(
+		fsfd, since, children if since > 0 else ())
+	gen = max(gen, tree_gen)
+	for tree in moved:
+		todo += children[tree]
+	changed = set()
+	while todo:
+		sv_id = todo.pop()
+		if sv_id not in changed:
+			changed.add(sv_id)
+			todo += children.get(sv_id, [])
+
+	sv_paths = {}
+	dir_paths = LRUCache(PATH_CACHE_SIZE)
+	def sv_path(sv_id):
+		"""Get the path of a subvolume within its parent
+		"""
+		if sv_id not in sv_paths:
+			name, parent, dirid, transid = backrefs[sv_id]
+			sv_paths[sv_id] = local_path(fsfd, parent, dirid, dir_paths)
+		return sv_paths[sv_id]
+
+	res = {}
+	for sv_id in changed:
+		name, parent_id, dirid, transid = backrefs[sv_id]
+		item = {}
+		item["name"] = name
+		item["id"] = sv_id
+		item["parent"] = parent_id
+		item["sv_path"] = sv_path(sv_id)
+
+		# Reconstruct the full subvolume path
+		item["full_path"] = item["sv_path"]
+		while parent_id != btrfs.FS_TREE_OBJECTID:
+			item["full_path"] = sv_path(parent_id) \
+								+ [backrefs[parent_id][0],] \
+								+ item["full_path"]
+			parent_id = backrefs[parent_id][1]
+		res[sv_id] = item
+
+	default = _default_subvol(fsfd)
+	if default in res:
+		res[default]["default"] = True
+	elif default not in backrefs and default not in (None, btrfs.FS_TREE_OBJECTID):
+		sys.stderr.write("Hmm. Found a default subvolume ({0}), but this subvolume is not present.\n".format(default))
+
+	return res, sorted(backrefs.keys()), gen, default
+
 def sv_list(params):
 	"""List all the subvolumes on the filesystem.
 	"""
 	uuid = params[0]
-	res = {}
 	with Filesystem(uuid) as fsfd:
-		# Find all trees in the tree of tree roots
-		min_tree = btrfs.FIRST_FREE_OBJECTID
-		min_key = 0
-		buf = btrfs.sized_array()
-		while True:
-			items = btrfs.search(fsfd,
-								 btrfs.ROOT_TREE_OBJECTID,
-								 (min_tree, btrfs.MINUS_ONE),
-								 (min_key, 255),
-								 buf=buf,
-								 structure=btrfs.root_ref)
-			if not items:
-				break
-			while items:
-				item = {}
-				header, raw_data, data = items.pop(0)
-				min_tree = sv_id = header[1]
-				min_key = found_key = header[3]
-
-				min_key += 1
-				if min_key >= 256:
-					min_tree += 1
-					min_key = 0
-
-				if header[3] != btrfs.ROOT_BACKREF_KEY:
-					continue
-				sv_parent_subvol = header[2]
-
-				dirid, sequence, name_len = data
-				name = struct.unpack_from("{0}s".format(name_len),
-										  raw_data,
-										  btrfs.root_ref.size)[0]
-
-				item["name"] = name
-				item["id"] = sv_id
-				item["parent"] = sv_parent_subvol
-				# Get the path of this subvolume within its parent
-				item["sv_path"] = local_path(fsfd, sv_parent_subvol, dirid)
-				res[sv_id] = item
-
-		# Reconstruct the full subvolume path in each case
-		for sv_id, data in res.items():
-			parent_id = data["parent"]
-			data["full_path"] = data["sv_path"]
-			while parent_id != btrfs.FS_TREE_OBJECTID:
-				data["full_path"] = res[parent_id]["sv_path"] \
-									+ [res[parent_id]["name"],] \
-									+ data["full_path"]
-				parent_id = res[parent_id]["parent"]
-
-		# Look for the default subvolume
-		items = btrfs.search(fsfd,
-							 btrfs.ROOT_TREE_OBJECTID,
-							 btrfs.ROOT_TREE_DIR_OBJECTID,
-							 btrfs.DIR_ITEM_KEY,
-							 buf=buf,
-							 structure=btrfs.dir_item)
-		while items:
-			header, raw_data, data = items.pop(0)
-			name = struct.unpack_from("{0}s".format(data[5]),
-									  raw_data,
-									  btrfs.dir_item.size)[0]
-			if name == "default":
-				if data[0] in res:
-					res[data[0]]["default"] = True
-				elif data[0] != btrfs.FS_TREE_OBJECTID:
-					sys.stderr.write("Hmm. Found a default subvolume ({0}), but this subvolume is not present.\n".format(data[0]))
-				break
+		res, ids, gen, default = _list_subvols(fsfd)
+
+	emit(res)
+
+def sv_list_since(params):
+	"""List the subvolumes on the filesystem which have been added or
+	changed since the given generation:
+
+	sub_list_since <uuid> <generation>
+
+	Pass the generation returned by the previous call (or 0 for
+	everything). The result also contains the IDs of all current
+	subvolumes, so that deleted ones can be identified, and the ID of
+	the default subvolume.
+	"""
+	uuid, since = params
+	with Filesystem(uuid) as fsfd:
+		res, ids, gen, default = _list_subvols(fsfd, int(since))
 
-	sys.stdout.write(json.dumps(res))
-	sys.stdout.write("\n")
+	emit({"generation": gen,
+		  "ids": ids,
+		  "subvols": res,
+		  "default": default})
 
 def sv_del(params):
 	"""Delete a subvolume, by ID.
@@ -7,39 +7,205 @@ listing the contents of a directory, or performing file operations.
 import os
 import sys
 import os.path
-import json
 import stat
+import threading
+import itertools
+import time
 
-from btrfsgui.hlp.mount import Filesystem
+from btrfsgui.hlp.mount import acquire, release
+from btrfsgui.hlp.lib import HelperException, emit
 
-_filters = { "all": lambda s: True,
-			 "dir": stat.S_ISDIR,
-			 "block": stat.S_ISBLK
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+class _DirEntry(object):
+	"""Enough of os.DirEntry for ls(), on pythons without scandir
+	"""
+	def __init__(self, path, name):
+		self.name = name
+		self.path = os.path.join(path, name)
+		self._stat = None
+		self._lstat = None
+
+	def stat(self, follow_symlinks=True):
+		if not follow_symlinks:
+			if self._lstat is None:
+				self._lstat = os.lstat(self.path)
+			return self._lstat
+		if self._stat is None:
+			self._stat = os.stat(self.path)
+		return self._stat
+
+	def inode(self):
+		return self.stat(follow_symlinks=False).st_ino
+
+	def is_dir(self):
+		return stat.S_ISDIR(self.stat().st_mode)
+
+def _inode(entry):
+	"""Return the inode number of a directory entry. For a subvolume,
+	readdir gives the ID of its tree rather than the inode of its top
+	directory, which is always 256, so directories are stat()ed.
+	"""
+	if entry.is_dir():
+		return entry.stat(follow_symlinks=False).st_ino
+	return entry.inode()
+
+def _listdir_entries(path):
+	for name in os.listdir(path):
+		yield _DirEntry(path, name)
+
+# These work on directory entries. Where the filesystem tells us the
+# type of each entry, is_dir() doesn't need to stat it.
+_filters = { "all": lambda entry: True,
+			 "dir": lambda entry: entry.is_dir(),
+			 "block": lambda entry: stat.S_ISBLK(entry.stat().st_mode)
 			 }
 
+# Most directory listings left open between pages of ls, and how long
+# one is kept after its last page was fetched, in seconds
+MAX_LISTINGS = 32
+LISTING_TIMEOUT = 300
+
+# Open listings, by cursor
+_listings = {}
+_listings_lock = threading.Lock()
+_cursors = itertools.count(1)
+
+class _Listing(object):
+	"""A directory being listed a page at a time. The directory is
+	kept open, and its filesystem mounted, until the last page has
+	been fetched, so that each page carries on from where the last
+	one stopped.
+	"""
+	def __init__(self, uuid, path, typefilter):
+		self.mount = acquire(uuid)
+		try:
+			path = os.path.join(self.mount.path, path)
+			if scandir is not None:
+				self.entries = scandir(path)
+			else:
+				self.entries = _listdir_entries(path)
+		except:
+			release(self.mount)
+			raise
+		self.typefilter = typefilter
+		# An entry read to check whether there's another page
+		self.pending = None
+		self.last_used = time.time()
+
+	def read(self):
+		"""Return the next entry which passes the filter, or None at
+		the end of the directory
+		"""
+		if self.pending is not None:
+			item, self.pending = self.pending, None
+			return item
+		for entry in self.entries:
+			try:
+				if self.typefilter(entry):
+					return {"name": entry.name, "inode": _inode(entry)}
+			except OSError:
+				# It's gone away since we read the directory
+				continue
+		return None
+
+	def close(self):
+		close = getattr(self.entries, "close", None)
+		if close is not None:
+			close()
+		release(self.mount)
+
+def _expire_listings():
+	"""Close the listings which haven't been used for LISTING_TIMEOUT
+	seconds, and the oldest ones beyond MAX_LISTINGS
+	"""
+	now = time.time()
+	with _listings_lock:
+		by_age = sorted(_listings.items(), key=lambda l: l[1].last_used)
+		expired = by_age[:max(0, len(by_age) - MAX_LISTINGS)]
+		expired += [l for l in by_age[len(expired):]
+					if now - l[1].last_used >= LISTING_TIMEOUT]
+		for cursor, listing in expired:
+			del _listings[cursor]
+	for cursor, listing in expired:
+		listing.close()
+
 def ls(params):
 	"""Return a listing of a directory as multiple objects:
 
-	ls [-<filtername>] <uuid> <path>
+	ls [-<filtername>] [-limit=<n>] [-cursor=<cursor>] <uuid> <path>
 	
-	Pass . as the path to obtain the root dir listing.
+	Pass . as the path to obtain the root dir listing. With -limit,
+	return at most that many of the entries which pass the filter,
+	followed, if there are more, by an object holding a cursor. Pass
+	that back with -cursor (and the same uuid and path) to get the
+	next page: the directory is kept open in between, so each page
+	costs the same however far into the directory it is. A cursor
+	expires if it's not used for LISTING_TIMEOUT seconds.
+
+	The order of the entries is the order they are stored in the
+	directory. If the directory changes between pages, entries may
+	be missed or repeated.
 	"""
-	if len(params) == 3:
-		p, uuid, path = params
-		typefilter = _filters[p[1:]]
-	else:
-		uuid, path = params
-		typefilter = _filters["all"]
+	typefilter = _filters["all"]
+	limit = None
+	cursor = None
+	while len(params) > 2 and params[0].startswith("-"):
+		name, tmp, value = params.pop(0)[1:].partition("=")
+		if name == "limit":
+			limit = int(value)
+		elif name == "cursor":
+			cursor = value
+		elif name in _filters:
+			typefilter = _filters[name]
+		else:
+			raise HelperException("Unknown ls option -{0}".format(name), 400)
+	uuid, path = params
 
 	# If we don't do this, we get to be able to list the whole host's
 	# filesystem
 	if path[0] == '/':
 		path = path.lstrip("/")
 
-	with Filesystem(uuid) as fs:
-		path = fs.fullpath(path)
-		for name in os.listdir(path):
-			_output_file_details(typefilter, path, name)
+	_expire_listings()
+	if cursor is None:
+		listing = _Listing(uuid, path, typefilter)
+	else:
+		with _listings_lock:
+			listing = _listings.pop(cursor, None)
+		if listing is None:
+			raise HelperException("Directory listing has expired", 404)
+
+	try:
+		count = 0
+		while limit is None or count < limit:
+			item = listing.read()
+			if item is None:
+				break
+			emit(item)
+			count += 1
+		# Only offer another page if there is one
+		if count == limit:
+			listing.pending = listing.read()
+	except:
+		listing.close()
+		raise
+
+	if listing.pending is None:
+		listing.close()
+		return
+	if cursor is None:
+		cursor = str(next(_cursors))
+	listing.last_used = time.time()
+	with _listings_lock:
+		_listings[cursor] = listing
+	emit({"cursor": cursor})
 
 def ls_blk(params):
 	"""Return a listing of all the block devices in /dev
@@ -99,6 +265,4 @@ def ls_blk(params):
 					sys.stderr.write("LVM device name with no apparent LV part {0}: ignoring LVM metadata\n".format(f))
 
 	for dev in devs.values():
-		sys.stdout.write(json.dumps(dev))
-		sys.stdout.write("\n")
-		sys.stdout.flush()
+		emit(dev)
@@ -1,26 +1,48 @@
 # -*- coding: utf-8 -*-
 
+import sys
 from optparse import OptionParser
 
-from btrfsgui.sudo import init_root_process
+from btrfsgui.sudo import init_root_process, SessionPool
+from btrfsgui.requester import RequesterException
 from btrfsgui.gui import Application
 
 def main():
 	parser = OptionParser()
-	parser.add_option("-R", "--remote", action="store", dest="ssh",
-					  metavar="<host>",
-					  help="Run on the remote system <host>")
+	parser.add_option("-R", "--remote", action="append", dest="ssh",
+					  metavar="<host>", default=[],
+					  help="Run on the remote system <host>. Give this more than once to manage several hosts")
 	parser.add_option("-s", "--sudo", action="store", dest="sudo_helper",
 					  metavar="<cmd>",
 					  help="Use <cmd> for gaining root privileges")
+	parser.add_option("-D", "--daemon-socket", action="store",
+					  dest="daemon_socket", metavar="<path>",
+					  help="Use the helper daemon listening on <path> for this machine")
 	parser.add_option("-H", "--helper", action="store", dest="helper",
 					  metavar="<path>", default="btrfs-gui-helper",
 					  help="Location of the root-helper to use")
+	parser.add_option("-F", "--framed", action="store_true", default=False,
+					  dest="framed",
+					  help="Use the binary framed protocol with the helper")
+	parser.add_option("--no-compress", action="store_false", default=True,
+					  dest="compress",
+					  help="Don't compress traffic to a remote helper")
 	parser.add_option("--force-root", action="store_true", default=False,
 					  dest="force_root",
 					  help="Run the GUI as root anyway")
 	(options, args) = parser.parse_args()
 
-	subproc = init_root_process(options)
-	app = Application(subproc, options)
+	# Only the first host is connected to at startup: the others
+	# wait until they're opened
+	hosts = options.ssh or [None]
+	sessions = SessionPool(options, hosts)
+	if hosts[0] is None and options.daemon_socket:
+		try:
+			sessions.get(None)
+		except RequesterException as ex:
+			sys.stderr.write(ex.message + "\n")
+			sys.exit(1)
+	else:
+		sessions.add(hosts[0], init_root_process(options, hosts[0]))
+	app = Application(sessions, options)
 	app.mainloop()
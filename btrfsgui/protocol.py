@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+"""The binary framed wire format spoken between the GUI and the root
+helper, as an alternative to lines of text and JSON.
+
+Once negotiated, every request and every part of a reply is sent as
+a frame: a fixed header of (kind, tag, length), followed by <length>
+bytes of payload encoded with the negotiated codec. A request's
+payload is the list of its arguments; data frames carry one object
+each, and the final OK or ERR frame of a reply carries [rv, message].
+
+Either protocol may also be run over a zlib-compressed stream, which
+is flushed at the end of every reply and request, to save bandwidth
+when the helper is on the far side of a slow link.
+
+This module is shared by the GUI (python 3) and the helper (python 2
+or 3), so it must work in both.
+"""
+
+import os
+import sys
+import json
+import struct
+import zlib
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+# kind, tag, length
+frame_header = struct.Struct("!cLL")
+
+REQUEST = b"Q"
+DATA = b"D"
+OK = b"K"
+ERR = b"E"
+
+class JSONCodec(object):
+	name = "json"
+
+	def encode(self, obj):
+		return json.dumps(obj).encode("utf-8")
+
+	def decode(self, data):
+		return json.loads(data.decode("utf-8"))
+
+class MsgpackCodec(object):
+	name = "msgpack"
+
+	def encode(self, obj):
+		return msgpack.packb(obj, use_bin_type=False)
+
+	def decode(self, data):
+		return msgpack.unpackb(data, raw=False)
+
+CODECS = {"json": JSONCodec}
+if msgpack is not None:
+	CODECS["msgpack"] = MsgpackCodec
+
+def codec_names():
+	"""Return the names of the codecs we can use, most preferred first
+	"""
+	return sorted(CODECS.keys(), key=lambda name: name == "json")
+
+def get_codec(name):
+	return CODECS[name]()
+
+def parse_features(words):
+	"""Parse the feature list from the helper's ready message into a
+	dictionary of feature -> list of values. Features are either bare
+	words, or of the form name=value,value,...
+	"""
+	features = {}
+	for word in words:
+		name, tmp, values = word.partition("=")
+		features[name] = [v for v in values.split(",") if v != ""]
+	return features
+
+def pack_frame(kind, tag, payload):
+	return frame_header.pack(kind, int(tag), len(payload)) + payload
+
+def read_frame(stream):
+	"""Read a frame from a binary stream. Returns (kind, tag, payload),
+	or None at the end of the stream.
+	"""
+	header = _read_exact(stream, frame_header.size)
+	if header is None:
+		return None
+	kind, tag, length = frame_header.unpack(header)
+	payload = _read_exact(stream, length)
+	if payload is None:
+		raise IOError("Truncated frame")
+	return (kind, tag, payload)
+
+def _read_exact(stream, length):
+	"""Read exactly <length> bytes from the stream, or return None if
+	it ends before any arrive.
+	"""
+	data = b""
+	while len(data) < length:
+		chunk = stream.read(length - len(data))
+		if not chunk:
+			if data == b"":
+				return None
+			raise IOError("Truncated frame")
+		data += chunk
+	return data
+
+class CompressedReader(object):
+	"""Read a stream written by CompressedWriter, as a binary file
+	object with read() and readline()
+	"""
+	def __init__(self, stream):
+		self.fd = stream.fileno()
+		self.decompressor = zlib.decompressobj()
+		self.buf = bytearray()
+
+	def _fill(self):
+		"""Decompress whatever is available on the stream, waiting for
+		at least some of it. Returns False at the end of the stream.
+		"""
+		data = os.read(self.fd, 65536)
+		if not data:
+			return False
+		self.buf += self.decompressor.decompress(data)
+		return True
+
+	def _take(self, length):
+		data = bytes(self.buf[:length])
+		del self.buf[:length]
+		return data
+
+	def read(self, length):
+		while len(self.buf) < length and self._fill():
+			pass
+		return self._take(length)
+
+	def readline(self):
+		start = 0
+		while True:
+			pos = self.buf.find(b"\n", start)
+			if pos >= 0:
+				return self._take(pos+1)
+			start = len(self.buf)
+			if not self._fill():
+				return self._take(len(self.buf))
+
+class CompressedWriter(object):
+	"""Compress everything written to a binary stream. Each flush()
+	sends all the data written so far.
+	"""
+	def __init__(self, stream, level=6):
+		self.stream = stream
+		self.compressor = zlib.compressobj(level)
+
+	def write(self, data):
+		if not isinstance(data, bytes):
+			data = data.encode("utf-8")
+		self.stream.write(self.compressor.compress(data))
+
+	def flush(self):
+		self.stream.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+		self.stream.flush()
+
+if sys.version_info[0] < 3:
+	def native_str(s):
+		"""Decoded strings come back as unicode in python 2: make them
+		ordinary strings, as the rest of the helper expects.
+		"""
+		if isinstance(s, unicode):
+			return s.encode("utf-8")
+		return s
+else:
+	def native_str(s):
+		"""Make text read from a binary stream into an ordinary string
+		"""
+		if isinstance(s, bytes):
+			return s.decode("utf-8")
+		return s
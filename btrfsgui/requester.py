@@ -1,83 +1,413 @@
 # -*- coding: utf-8 -*-
 
 import json
+import errno
+import collections
+import threading
+import queue
 import tkinter.messagebox
 
+import btrfsgui.protocol as protocol
+
 class RequesterException(Exception):
 	def __init__(self, msg, value=500):
 		self.message = msg
 		self.rv = value
 
-class Requester(object):
-	"""Mixin class for classes which make requests of the root-level
-	helper process. Flush requests, parse return values, and the like.
+class Connection(object):
+	"""A connection to the root helper process. Requests are tagged
+	with an ID, so several of them can be in flight at once, and
+	their replies matched up however they come back.
+
+	The helper's pipes are binary: we speak lines of text and JSON to
+	it, unless use_frames() switches to the framed protocol, possibly
+	compressed by use_compression().
+
+	Once start() has been called, a background thread reads the
+	replies, and replies to requests made with submit_async() are
+	handed back to the main thread by dispatch().
 	"""
-	def __init__(self, comms):
-		self.comms = comms
+	def __init__(self, proc, features=()):
+		self.proc = proc
+		self.rfile = proc.stdout
+		self.wfile = proc.stdin
+		self.features = protocol.parse_features(features)
+		self.tagged = "tags" in self.features
+		# The codec for the framed protocol, if we're using it
+		self.codec = None
+		self.next_tag = 0
+		# Tags of the requests not yet completed, oldest first
+		self.outstanding = collections.deque()
+		# Parts of replies read but not yet consumed, by tag: each is
+		# a (kind, value) pair
+		self.pending = {}
+		self.finished = {}
+		# The reader thread, and the lock protecting the above from it
+		self.reader = None
+		self.lock = threading.Lock()
+		self.arrived = threading.Condition(self.lock)
+		self.error = None
+		# Callbacks for asynchronous requests, by tag, and the tags of
+		# completed ones waiting to be dispatched
+		self.callbacks = {}
+		self.completed = queue.Queue()
 
-	def request(self, *parts):
-		"""Send a request, parse the result stream in file object f,
-		and return the data correctly.
+	def use_compression(self):
+		"""Compress the streams to and from the helper, if it supports
+		it. This must be done before any requests are made. Returns
+		True if we switched.
 		"""
-		ret = None
+		if "zlib" not in self.features:
+			return False
+
+		self.wfile.write(b"proto zlib\n")
+		self.wfile.flush()
+		line = self.rfile.readline().decode()
+		if not line.startswith("OK"):
+			return False
+		self.rfile = protocol.CompressedReader(self.proc.stdout)
+		self.wfile = protocol.CompressedWriter(self.proc.stdin)
+		return True
+
+	def use_frames(self):
+		"""Switch to the binary framed protocol, if the helper supports
+		it, with the best codec we both have. This must be done before
+		any requests are made. Returns True if we switched.
+		"""
+		offered = self.features.get("frames", [])
+		for name in protocol.codec_names():
+			if name in offered:
+				break
+		else:
+			return False
+
+		self.wfile.write("proto frames {0}\n".format(name).encode())
+		self.wfile.flush()
+		line = self.rfile.readline().decode()
+		if not line.startswith("OK"):
+			return False
+		self.codec = protocol.get_codec(name)
+		self.tagged = True
+		return True
+
+	def submit(self, *parts):
+		"""Send a request without waiting for the reply. Returns the
+		tag to pass to collect() or results().
+		"""
+		return self._send(parts, None)
+
+	def submit_async(self, callback, *parts):
+		"""Send a request, and arrange for callback(tag) to be called
+		by dispatch() once the whole reply has arrived. The callback
+		can then collect() the result without waiting.
+		"""
+		return self._send(parts, callback)
 
-		req = " ".join([str(p).replace("\\", "\\\\").replace(" ", "\\ ")
-						for p in parts])
+	def _send(self, parts, callback):
+		tag = str(self.next_tag)
+		self.next_tag += 1
 
-		self.comms.stdin.write(req)
-		self.comms.stdin.write("\n")
-		self.comms.stdin.flush()
+		if self.codec is not None:
+			req = protocol.pack_frame(
+				protocol.REQUEST, tag,
+				self.codec.encode([str(p) for p in parts]))
+		else:
+			req = " ".join([str(p).replace("\\", "\\\\").replace(" ", "\\ ")
+							for p in parts])
+			if self.tagged:
+				req = "@{0} {1}".format(tag, req)
+			req = (req + "\n").encode("utf-8")
 
+		# Be ready for the reply before it can possibly arrive
+		with self.lock:
+			self.outstanding.append(tag)
+			self.pending[tag] = collections.deque()
+			if callback is not None:
+				self.callbacks[tag] = callback
+		try:
+			self.wfile.write(req)
+			self.wfile.flush()
+		except:
+			with self.lock:
+				self.outstanding.remove(tag)
+				del self.pending[tag]
+				self.callbacks.pop(tag, None)
+			raise
+		return tag
+
+	def start(self):
+		"""Start reading replies on a background thread
+		"""
+		self.reader = threading.Thread(target=self._read_replies)
+		self.reader.daemon = True
+		self.reader.start()
+
+	def dispatch(self):
+		"""Call the callbacks of any completed asynchronous requests.
+		This must be called from the thread which makes requests.
+		"""
 		while True:
-			line = self.comms.stdout.readline()
-			if line.startswith("OK"):
-				tmp, rv, message = line.split(None, 2)
-				break
-			elif line.startswith("ERR"):
-				tmp, rv, message = line.split(None, 2)
+			try:
+				callback, tag = self.completed.get_nowait()
+			except queue.Empty:
+				return
+			callback(tag)
+
+	def busy(self):
+		"""Return the number of requests waiting for replies
+		"""
+		with self.lock:
+			if self.error is not None:
+				# None of them are going to arrive now
+				return 0
+			return len(self.outstanding)
+
+	def results(self, tag):
+		"""Return the data objects of the reply to request <tag>, as
+		they arrive. Raises RequesterException if the request failed.
+		Once the reply is complete, its (rv, message) are left in
+		self.finished[tag].
+		"""
+		while True:
+			kind, value = self._next_item(tag)
+			if kind == protocol.OK:
+				del self.pending[tag]
+				self.finished[tag] = value
+				return
+			elif kind == protocol.ERR:
+				del self.pending[tag]
+				rv, message = value
 				raise RequesterException(message, rv)
 			try:
-				ret = json.loads(line)
+				if self.codec is not None:
+					yield self.codec.decode(value)
+				else:
+					yield json.loads(value)
 			except ValueError:
 				raise RequesterException("Unparsable data", 599)
+
+	def collect(self, tag):
+		"""Wait for the reply to request <tag>, and return it as (rv,
+		message, data), where data is the last object in the reply.
+		"""
+		ret = None
+		for ret in self.results(tag):
+			pass
+		rv, message = self.finished.pop(tag)
 		return (rv, message, ret)
 
-	def request_array(self, *parts):
-		"""Send a requrest, parse repeated lines of output in file
-		object f, and return the data correctly.
+	def _next_item(self, tag):
+		"""Return the next part of the reply to request <tag>,
+		reading (and keeping) replies to other requests on the way.
 		"""
-		req = " ".join([str(p).replace("\\", "\\\\").replace(" ", "\\ ")
-						for p in parts])
+		replies = self.pending[tag]
+		if self.reader is not None:
+			with self.lock:
+				while len(replies) == 0:
+					if self.error is not None:
+						raise self.error
+					self.arrived.wait()
+				return replies.popleft()
+
+		while len(replies) == 0:
+			self._file_item(*self._read_item())
+		return replies.popleft()
 
-		self.comms.stdin.write(req)
-		self.comms.stdin.write("\n")
-		self.comms.stdin.flush()
+	def _read_item(self):
+		if self.codec is not None:
+			return self._read_frame()
+		return self._read_line()
+
+	def _file_item(self, tag, kind, value):
+		"""Keep a part of a reply until it's asked for. Called with
+		self.lock held, if the reader thread is running.
+		"""
+		self.pending[tag].append((kind, value))
+		if kind != protocol.DATA:
+			self.outstanding.remove(tag)
+			if tag in self.callbacks:
+				self.completed.put((self.callbacks.pop(tag), tag))
 
-		def ret():
+	def _read_replies(self):
+		"""Reader thread: read replies from the helper as they come
+		"""
+		try:
 			while True:
-				line = self.comms.stdout.readline()
-				if line.startswith("OK"):
+				tag, kind, value = self._read_item()
+				with self.lock:
+					self._file_item(tag, kind, value)
+					self.arrived.notify_all()
+		except Exception as ex:
+			# Whatever went wrong, we've lost our place in the stream,
+			# so the connection is as good as dead
+			if not (isinstance(ex, IOError) and ex.errno == errno.EPIPE):
+				ex = IOError(errno.EPIPE,
+							 "Lost the root helper's replies: {0}".format(ex))
+			# Wake up everything waiting for a reply, so that it can
+			# see the error
+			with self.lock:
+				self.error = ex
+				for tag, callback in self.callbacks.items():
+					self.completed.put((callback, tag))
+				self.callbacks = {}
+				self.arrived.notify_all()
+
+	def _read_line(self):
+		"""Read a line of a reply. Returns (tag, kind, value), where
+		value is the text of a data line, or (rv, message).
+		"""
+		line = self.rfile.readline().decode("utf-8")
+		if line == "":
+			raise IOError(errno.EPIPE, "Root helper has stopped")
+		if self.tagged and line.startswith("@"):
+			tag, tmp, line = line[1:].partition(" ")
+		else:
+			# Untagged replies come back in order
+			tag = self.outstanding[0]
+
+		if line.startswith("OK"):
+			tmp, rv, message = line.split(None, 2)
+			return (tag, protocol.OK, (rv, message))
+		elif line.startswith("ERR"):
+			tmp, rv, message = line.split(None, 2)
+			return (tag, protocol.ERR, (rv, message))
+		return (tag, protocol.DATA, line)
+
+	def _read_frame(self):
+		"""Read a frame of a reply. Returns (tag, kind, value), where
+		value is the encoded payload of a data frame, or (rv, message).
+		"""
+		frame = protocol.read_frame(self.rfile)
+		if frame is None:
+			raise IOError(errno.EPIPE, "Root helper has stopped")
+		kind, tag, payload = frame
+		if kind == protocol.DATA:
+			return (str(tag), kind, payload)
+		rv, message = self.codec.decode(payload)
+		return (str(tag), kind, (str(rv), message))
+
+class CancelToken(object):
+	"""Shared by a group of asynchronous requests which may turn out
+	not to be wanted. Once it's cancelled, those not yet sent aren't
+	sent, and the results of the rest are thrown away.
+	"""
+	def __init__(self):
+		self.cancelled = False
+
+	def cancel(self):
+		self.cancelled = True
+
+class Requester(object):
+	"""Mixin class for classes which make requests of the root-level
+	helper process. Flush requests, parse return values, and the like.
+	"""
+	def __init__(self, comms):
+		self.comms = comms
+
+	def request(self, *parts):
+		"""Send a request, wait for the result, and return the data
+		correctly.
+		"""
+		return self.comms.collect(self.comms.submit(*parts))
+
+	def submit(self, *parts):
+		"""Send a request, and return a tag for collecting the result
+		later. Requests can be pipelined by submitting several before
+		collecting any of them.
+		"""
+		return self.comms.submit(*parts)
+
+	def collect(self, tag):
+		"""Wait for the result of a submit()ted request, and return
+		the data correctly.
+		"""
+		return self.comms.collect(tag)
+
+	def request_async(self, callback, *parts, errback=None, token=None):
+		"""Send a request without waiting for the result. Once it has
+		arrived, callback(rv, message, data) is called from the event
+		loop. If the request fails, errback(exception) is called
+		instead, or by default the error is reported to the user. If
+		the CancelToken <token> has been cancelled by then, nothing is
+		called.
+		"""
+		if token is not None and token.cancelled:
+			return None
+
+		def done(tag):
+			try:
+				result = self.comms.collect(tag)
+			except (RequesterException, IOError) as ex:
+				if token is not None and token.cancelled:
 					return
-				if line.startswith("ERR"):
-					tmp, code, message = line.split(None, 2)
-					raise RequesterException(message, code)
-				try:
-					data = json.loads(line)
-				except ValueError:
-					raise RequesterException("Unparsable data", 599)
-				yield data
+				if errback is not None:
+					errback(ex)
+				elif not report_error(ex):
+					raise
+				return
+			if token is not None and token.cancelled:
+				return
+			callback(*result)
+
+		return self.comms.submit_async(done, *parts)
 
-		return (100, "Not immediately fatal", ret())
+	def request_all_async(self, callback, *requests, errback=None,
+						  token=None):
+		"""Send several requests at once, each given as a tuple of its
+		parts. Once all of them have completed, callback(results) is
+		called with a list of the (rv, message, data) of each, in
+		order.
+		"""
+		results = [None] * len(requests)
+		waiting = set(range(len(requests)))
+		failed = []
+
+		def done(i, *result):
+			results[i] = result
+			waiting.discard(i)
+			if len(waiting) == 0 and not failed:
+				callback(results)
+
+		def fail(ex):
+			# Only report the first failure
+			if not failed:
+				failed.append(ex)
+				if errback is not None:
+					errback(ex)
+				elif not report_error(ex):
+					raise ex
+
+		for i, parts in enumerate(requests):
+			self.request_async(lambda *result, i=i: done(i, *result),
+							   *parts, errback=fail, token=token)
+
+	def request_array(self, *parts):
+		"""Send a requrest, parse repeated lines of output, and
+		return the data correctly, as a list of all the objects in
+		the reply.
+		"""
+		tag = self.comms.submit(*parts)
+		data = list(self.comms.results(tag))
+		rv, message = self.comms.finished.pop(tag)
+		return (100, "Not immediately fatal", data)
+
+def report_error(ex):
+	"""Tell the user about a failed request. Returns False if the
+	exception isn't one we know how to report.
+	"""
+	if isinstance(ex, RequesterException):
+		tkinter.messagebox.showerror("Error", ex.message)
+		return True
+	if isinstance(ex, IOError) and ex.errno == 32: # Broken pipe
+		tkinter.messagebox.showerror(title="This helper is dead", message="Root helper has stopped unexpectedly. Restart the application to continue.")
+		return True
+	return False
 
 def ex_handler(fn):
 	def hdlr(*args, **kwargs):
 		try:
 			return fn(*args, **kwargs)
-		except RequesterException as rq:
-			tkinter.messagebox.showerror("Error", rq.message)
-		except IOError as ioe:
-			if ioe.errno == 32: # Broken pipe
-				tkinter.messagebox.showerror(title="This helper is dead", message="Root helper has stopped unexpectedly. Restart the application to continue.")
-			else:
+		except (RequesterException, IOError) as ex:
+			if not report_error(ex):
 				raise
 	return hdlr
@@ -8,11 +8,47 @@
 
 import sys
 import os
+import socket
 import subprocess
 
-def init_root_process(params):
+from btrfsgui.requester import Connection, RequesterException
+
+# Share one ssh connection between all the sessions to a host, and
+# keep it open for a while after the last one has gone, so that
+# reconnecting is quick
+SSH_OPTIONS = ["-o", "ControlMaster=auto",
+			   "-o", "ControlPath=~/.ssh/btrfs-gui-%r@%h:%p",
+			   "-o", "ControlPersist=10m"]
+
+def init_root_process(params, host=None):
 	"""Initialise a co-process that runs as root, and which we can
-	communicate with to talk to the FS directly.
+	communicate with to talk to the FS directly. If host is given,
+	the helper is run there, over ssh.
+	"""
+	if os.geteuid() != 0 and not params.sudo_helper:
+		sys.stderr.write("Can't run without privileges: run through sudo, or use --sudo\n")
+		sys.exit(1)
+
+	subproc = start_helper(params, host)
+
+	if os.geteuid() == 0:
+		# We're root already -- see if we know where we came from via
+		# sudo, and can drop back to the ordinary user permanently
+		if "SUDO_GID" in os.environ:
+			os.setuid(int(os.environ["SUDO_GID"]))
+		elif not params.force_root:
+			# We can't -- bomb out with an error
+			sys.stderr.write("This GUI must not be run as root. Use --force-root to override\n")
+			sys.exit(1)
+
+	try:
+		return _connect(params, host, subproc)
+	except RequesterException:
+		print("Couldn't start root helper. Aborted")
+		sys.exit(1)
+
+def start_helper(params, host):
+	"""Start the helper process, locally or on <host>
 	"""
 	pthshell = ":".join(["/sbin", "/bin", "/usr/sbin", "/usr/bin",
 						 "/usr/local/sbin", "/usr/bin", "."])
@@ -28,29 +64,88 @@ def init_root_process(params):
 		if params.sudo_helper:
 			cmd[0:0] = params.sudo_helper.split(" ")
 		else:
-			sys.stderr.write("Can't run without privileges: run through sudo, or use --sudo\n")
-			sys.exit(1)
+			raise RequesterException("Can't run without privileges: use --sudo")
 
-	if params.ssh:
-		cmd[0:0] = ["ssh"] + params.ssh.split(" ")
+	if host:
+		cmd[0:0] = ["ssh"] + SSH_OPTIONS + host.split(" ")
 
-	subproc = subprocess.Popen(
-		cmd, universal_newlines=True,
-		stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+	return subprocess.Popen(
+		cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
 
-	if os.geteuid() == 0:
-		# We're root already -- see if we know where we came from via
-		# sudo, and can drop back to the ordinary user permanently
-		if "SUDO_GID" in os.environ:
-			os.setuid(int(os.environ["SUDO_GID"]))
-		elif not params.force_root:
-			# We can't -- bomb out with an error
-			sys.stderr.write("This GUI must not be run as root. Use --force-root to override\n")
-			sys.exit(1)
+class DaemonSession(object):
+	"""A connection to a helper daemon, which looks enough like the
+	helper process to stand in for it.
+	"""
+	def __init__(self, path):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.connect(path)
+		self.stdin = self.sock.makefile("wb")
+		self.stdout = self.sock.makefile("rb")
 
-	line = subproc.stdout.readline()
-	if line.startswith("ERR"):
-		print("Couldn't start root helper. Aborted")
-		sys.exit(1)
+	def kill(self):
+		self.sock.close()
+
+def connect_daemon(params):
+	"""Attach to an already-running helper daemon
+	"""
+	try:
+		session = DaemonSession(params.daemon_socket)
+	except socket.error as ex:
+		raise RequesterException("Couldn't connect to helper daemon: {0}".format(ex))
+	try:
+		return _connect(params, None, session)
+	except:
+		session.kill()
+		raise
+
+def _connect(params, host, subproc):
+	"""Wait for a newly-started helper to be ready, and set up the
+	connection to it
+	"""
+	line = subproc.stdout.readline().decode()
+	if not line.startswith("OK"):
+		raise RequesterException("Couldn't start root helper")
+
+	# OK 200 Ready [<feature> ...]
+	features = line.split()[3:]
+	comms = Connection(subproc, features)
+	if host and params.compress:
+		# Compress everything crossing the network
+		comms.use_compression()
+	if params.framed:
+		comms.use_frames()
+	comms.start()
+	return comms
+
+class SessionPool(object):
+	"""Long-lived helper sessions to a number of hosts, each started
+	the first time it's needed and kept for reuse. The local machine
+	is the host None, which is served by the helper daemon if we've
+	been given its socket.
+	"""
+	def __init__(self, params, hosts):
+		self.params = params
+		self.hosts = hosts
+		self.sessions = {}
+
+	def add(self, host, comms):
+		"""Add an already-started session to the pool
+		"""
+		self.sessions[host] = comms
+
+	def get(self, host):
+		"""Return the session for a host, starting it if necessary
+		"""
+		if host not in self.sessions and host is None and self.params.daemon_socket:
+			self.sessions[host] = connect_daemon(self.params)
+		if host not in self.sessions:
+			subproc = start_helper(self.params, host)
+			try:
+				self.sessions[host] = _connect(self.params, host, subproc)
+			except:
+				subproc.kill()
+				raise
+		return self.sessions[host]
 
-	return subproc
+	def connected(self, host):
+		return host in self.sessions